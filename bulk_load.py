@@ -0,0 +1,96 @@
+# Bulk catalog loader for Microservice A and Microservice D
+# Usage: python bulk_load.py books.csv --service d --chunk-size 5000
+import argparse
+import csv
+import json
+import time
+from zmq_client import send_request
+
+SERVICE_PORTS = {"a": 5554, "d": 5557}
+BOOLEAN_FIELDS = ("available", "reserved")
+
+
+def coerce_row(row):
+    """Convert CSV strings to the types the services store."""
+    book = {key: value for key, value in row.items() if value not in (None, "")}
+    if isinstance(book.get("id"), str) and book["id"].isdigit():
+        book["id"] = int(book["id"])
+    for field in BOOLEAN_FIELDS:
+        if isinstance(book.get(field), str):
+            book[field] = book[field].strip().lower() in ("1", "true", "yes", "y")
+    return book
+
+
+def read_books(path, file_format=None):
+    """
+    Stream books from a CSV (with a header row) or JSON-lines file.
+    :param path: The file to read.
+    :param file_format: "csv" or "jsonl"; inferred from the extension if None.
+    :return: A generator of book dictionaries.
+    """
+    if file_format is None:
+        file_format = "csv" if path.lower().endswith(".csv") else "jsonl"
+    with open(path, newline="", encoding="utf-8") as f:
+        if file_format == "csv":
+            for row in csv.DictReader(f):
+                yield coerce_row(row)
+        else:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+
+
+def chunked(items, size):
+    """Yield lists of up to size items, flagging the last one."""
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk, False
+            chunk = []
+    # Always send a final chunk (possibly empty) so Service D merges what it staged
+    yield chunk, True
+
+
+def send_chunk(service, chunk, final):
+    """
+    Send one chunk to the service.
+    :return: (stored, duplicates) for the chunk.
+    """
+    if service == "a":
+        reply = send_request(SERVICE_PORTS["a"], [{'bulk_store_books': True}, chunk])
+        counts = reply[0].get('bulk_store_books')
+        if not isinstance(counts, dict):
+            raise RuntimeError(reply[0].get('error', "bulk load failed"))
+        return counts['stored'], counts['duplicates']
+    reply = send_request(SERVICE_PORTS["d"], ["bulk_load_books", {"books": chunk, "final": final}])
+    if reply.get("status") != "success":
+        raise RuntimeError(reply.get("message", "bulk load failed"))
+    return reply["staged"], reply["duplicates"]
+
+
+def load(path, service="d", chunk_size=5000, file_format=None):
+    """
+    Load a catalog file into a service and print progress as rows per second.
+    :return: (rows read, rows stored, duplicates skipped).
+    """
+    rows = stored = duplicates = 0
+    start = time.perf_counter()
+    for chunk, final in chunked(read_books(path, file_format), chunk_size):
+        chunk_stored, chunk_duplicates = send_chunk(service, chunk, final)
+        rows += len(chunk)
+        stored += chunk_stored
+        duplicates += chunk_duplicates
+        elapsed = time.perf_counter() - start
+        print(f"{rows} rows, {stored} stored, {duplicates} duplicates, {rows / elapsed:.0f} rows/s")
+    return rows, stored, duplicates
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Bulk load a book catalog into Microservice A or D.")
+    parser.add_argument("path", help="CSV or JSON-lines file of books")
+    parser.add_argument("--service", choices=sorted(SERVICE_PORTS), default="d")
+    parser.add_argument("--chunk-size", type=int, default=5000)
+    parser.add_argument("--format", choices=["csv", "jsonl"], dest="file_format")
+    args = parser.parse_args()
+    load(args.path, args.service, args.chunk_size, args.file_format)
@@ -0,0 +1,86 @@
+# Wire encodings shared by the microservices and their clients
+import json
+import os
+
+try:
+    import msgpack
+except ImportError:  # msgpack is optional; JSON is always available
+    msgpack = None
+
+JSON = "json"
+MSGPACK = "msgpack"
+
+# Environment variable choosing the codec clients prefer
+CODEC_ENV = "SERVICE_CODEC"
+
+
+def _json_encode(obj):
+    return json.dumps(obj).encode()
+
+
+def _json_decode(data):
+    return json.loads(data.decode())
+
+
+def _msgpack_encode(obj):
+    return msgpack.packb(obj, use_bin_type=True)
+
+
+def _msgpack_decode(data):
+    return msgpack.unpackb(data, raw=False, strict_map_key=False)
+
+
+_codecs = {JSON: (_json_encode, _json_decode)}
+if msgpack is not None:
+    _codecs[MSGPACK] = (_msgpack_encode, _msgpack_decode)
+
+
+def is_available(name):
+    return name in _codecs
+
+
+def default_codec():
+    """
+    The codec clients use unless told otherwise: SERVICE_CODEC if set and
+    available, otherwise msgpack when installed, otherwise JSON.
+    """
+    name = os.environ.get(CODEC_ENV)
+    if name and is_available(name):
+        return name
+    return MSGPACK if is_available(MSGPACK) else JSON
+
+
+def encode(obj, name=JSON):
+    return _codecs[name][0](obj)
+
+
+def decode(data, name=JSON):
+    return _codecs[name][1](data)
+
+
+def encode_frames(obj, name=None):
+    """
+    Frame a message for the wire.
+    A single frame is a plain JSON message, as sent by older clients.
+    Two frames are [codec name, body].
+    :param obj: The message to send.
+    :param name: The codec to use, or None for a plain JSON frame.
+    :return: The list of frames.
+    """
+    if name is None:
+        return [encode(obj)]
+    return [name.encode(), encode(obj, name)]
+
+
+def decode_frames(frames):
+    """
+    Decode a framed message.
+    :return: (message, codec name or None for a plain JSON frame).
+    :raises KeyError: If the codec named in the header is not available here.
+    """
+    if len(frames) == 1:
+        return decode(frames[0]), None
+    name = frames[0].decode()
+    if name not in _codecs:
+        raise KeyError(name)
+    return decode(frames[1], name), name
@@ -1,19 +1,14 @@
 import tkinter as tk
-from tkinter import messagebox
+import uuid
+from tkinter import messagebox, ttk
 from tkmacosx import Button
-import zmq
-import json
-from datetime import datetime, timedelta
-
-# Communicate with microservices
-def communicate_with_microservice(port, operation, data=None):
-    context = zmq.Context()
-    socket = context.socket(zmq.REQ)
-    socket.connect(f"tcp://localhost:{port}")
-    request = [operation, data]
-    socket.send(json.dumps(request).encode())
-    response = socket.recv()
-    return json.loads(response.decode())
+from zmq_client import communicate_with_microservice, send_batch, close_all
+from events import BOOK_TOPIC, BORROW_TOPIC, EVENT_PORTS, HISTORY_TOPIC, OVERDUE_TOPIC
+from request_cache import RequestCache
+from service_caller import ServiceCaller
+
+# Book fields the book list screen actually displays
+BOOK_LIST_FIELDS = ["id", "title", "author", "available", "held_for"]
 
 # Placeholder management for Entry fields
 def setup_entry_with_placeholder(entry, placeholder):
@@ -30,15 +25,65 @@ class LibraryApp:
         self.root.configure(bg="#f7f7f7")
         self.user_borrowed_books = []  # List of books borrowed by the user
         self.current_user = None  # Current user's ID
+        # Runs service calls in the background so the window never freezes
+        # Cached replies live for a minute; change events invalidate them sooner
+        self.caller = ServiceCaller(root, on_error=self.show_service_error, cache=RequestCache(ttl=60))
+        self.book_event_handler = None  # Set while the book list screen is shown
+        self.announced_holds = set()  # Books the user was already told are held for them
+        self.caller.subscribe(EVENT_PORTS[5557], [BOOK_TOPIC], self.on_book_event)
+        self.caller.subscribe(EVENT_PORTS[5556], [BORROW_TOPIC], self.on_borrow_event)
+        self.caller.subscribe(EVENT_PORTS[5556], [OVERDUE_TOPIC], self.on_overdue_event)
+        self.caller.subscribe(EVENT_PORTS[5558], [HISTORY_TOPIC], self.on_history_event)
 
         # Show the first screen
         self.show_first_screen()
 
     def clear_screen(self):
         """Clear all widgets from the screen."""
+        # Results for the old screen's pending calls would land on destroyed widgets
+        self.caller.cancel_screen()
+        self.book_event_handler = None
         for widget in self.root.winfo_children():
             widget.destroy()
 
+    def on_book_event(self, topic, event):
+        """A book changed in Microservice D, possibly at another desk: update the shown row in place."""
+        self.caller.cache.invalidate(5557)
+        if self.book_event_handler is not None:
+            self.book_event_handler(event)
+        if self.current_user is not None and event.get("held_for") == self.current_user:
+            if event["id"] not in self.announced_holds:
+                self.announced_holds.add(event["id"])
+                messagebox.showinfo("Reservation Ready", "A book you reserved has been returned and is being held for you.")
+        else:
+            self.announced_holds.discard(event.get("id"))
+
+    def on_borrow_event(self, topic, event):
+        """The current user's borrow records changed in Microservice B."""
+        if event["user_id"] == self.current_user:
+            self.caller.cache.invalidate(5556, "get_borrowed_books", self.current_user)
+            # Keep the borrowed ids in step with loans made or ended elsewhere, e.g. on another desk
+            if event["type"] == "borrow":
+                if event["book_id"] not in self.user_borrowed_books:
+                    self.user_borrowed_books.append(event["book_id"])
+            elif event["book_id"] in self.user_borrowed_books:
+                self.user_borrowed_books.remove(event["book_id"])
+
+    def on_overdue_event(self, topic, event):
+        """Alert the signed-in user when Microservice B finds that one of their loans became overdue."""
+        titles = [book["title"] for book in event["books"] if book["user_id"] == self.current_user]
+        if titles:
+            messagebox.showwarning("Overdue Books Alert", f"These books are now overdue: {', '.join(titles)}. Please return them.")
+
+    def on_history_event(self, topic, event):
+        """Microservice C recorded a change to the current user's history."""
+        if event["user_id"] == self.current_user:
+            self.caller.cache.invalidate(5558, "get_borrowing_history", self.current_user)
+
+    def show_service_error(self, error):
+        """Report a failed or timed-out service call."""
+        messagebox.showerror("Error", f"Service unavailable: {error}")
+
     def show_first_screen(self):
         """Show the initial screen with Login and Register options."""
         self.clear_screen()
@@ -99,15 +144,26 @@ class LibraryApp:
 
         def login():
             """Handle login functionality."""
-            response = communicate_with_microservice(5554, {'sign_in': True}, {"username": email.get(), "password": password.get()})
-            if response and response[0].get("sign_in"):
-                self.current_user = email.get()
-                messagebox.showinfo("Success", "Login successful!")
-                self.get_user_borrowed_books()  # Fetch the borrowed books after login
-                self.show_overdue_alerts()  
-                self.show_book_list_screen()
-            else:
-                messagebox.showerror("Error", "Invalid credentials!")
+            user_id = email.get()
+            timeout = self.caller.timeout
+
+            def on_results(results):
+                response, (borrowed, overdue) = results
+                if response and response[0].get("sign_in"):
+                    self.current_user = user_id
+                    messagebox.showinfo("Success", "Login successful!")
+                    self.get_user_borrowed_books(borrowed)
+                    self.show_overdue_alerts(overdue)
+                    self.show_book_list_screen()
+                else:
+                    messagebox.showerror("Error", "Invalid credentials!")
+
+            # Sign in with Microservice A while fetching the borrowed books and overdue alerts
+            # from Microservice B; B's results are simply discarded if sign in fails
+            self.caller.gather([
+                (communicate_with_microservice, (5554, {'sign_in': True}, {"username": user_id, "password": password.get()}, timeout)),
+                (send_batch, (5556, [["get_borrowed_books", user_id], ["check_overdue_books", user_id]], timeout)),
+            ], on_results)
 
         Button(
             self.root,
@@ -162,12 +218,17 @@ class LibraryApp:
                 messagebox.showerror("Error", "Passwords do not match!")
                 return
 
-            response = communicate_with_microservice(5554, {'sign_up': True}, {"username": email.get(), "password": password.get()})
-            if response and response[0].get("sign_up") == "username already exists":
-                messagebox.showerror("Error", "Email already registered!")
-            else:
-                messagebox.showinfo("Success", "Registration successful!")
-                self.show_login_screen()
+            def on_response(response):
+                if response and response[0].get("sign_up") == "username already exists":
+                    messagebox.showerror("Error", "Email already registered!")
+                elif response and response[0].get("error"):
+                    messagebox.showerror("Error", "Registration failed!")
+                else:
+                    messagebox.showinfo("Success", "Registration successful!")
+                    self.show_login_screen()
+
+            self.caller.request(5554, {'sign_up': True}, {"username": email.get(), "password": password.get()}, on_response,
+                                request_id=uuid.uuid4().hex)
 
         Button(
             self.root,
@@ -189,10 +250,12 @@ class LibraryApp:
             borderless=1
         ).pack(pady=10)
 
-    def get_user_borrowed_books(self):
-        """Fetch the list of borrowed books for the current user."""
+    def get_user_borrowed_books(self, response=None):
+        """Fetch the list of borrowed books for the current user, unless the response is already known."""
         # Fetch borrowed books from Microservice B ( user_id is self.current_user)
-        response = communicate_with_microservice(5556, "get_borrowed_books", self.current_user)
+        if response is None:
+            self.caller.request(5556, "get_borrowed_books", self.current_user, self.get_user_borrowed_books, screen=False)
+            return
         if response.get("status") == "success":
             self.user_borrowed_books = [book["book_id"] for book in response["borrowed_books"]]  # Save borrowed book IDs
         else:
@@ -203,11 +266,6 @@ class LibraryApp:
 
             tk.Label(self.root, text="Return Book", font=("Helvetica", 24, "bold"), bg="#f7f7f7", fg="#333").pack(pady=20)
 
-            # Fetch the borrowed books for the current user
-         
-            response = communicate_with_microservice(5558, "get_borrowing_history", self.current_user)
-            borrowed_books = response.get("borrowed_books", [])
-
             # Display borrowed books in a table with Borrowed Date and Due Date
             table_frame = tk.Frame(self.root, bg="#f7f7f7")
             table_frame.pack(pady=10, fill="both", expand=True)
@@ -218,22 +276,27 @@ class LibraryApp:
             tk.Label(table_frame, text="Due Date", font=("Helvetica", 14, "bold"), bg="#f7f7f7", fg="#333").grid(row=0, column=3, padx=10, pady=5, sticky="w")
             tk.Label(table_frame, text="Action", font=("Helvetica", 14, "bold"), bg="#f7f7f7", fg="#333").grid(row=0, column=4, padx=10, pady=5, sticky="w")
 
-            for i, book in enumerate(borrowed_books):
-                tk.Label(table_frame, text=book['book_id'], font=("Helvetica", 12), bg="#f7f7f7", fg="#555").grid(row=i + 1, column=0, padx=10, pady=5, sticky="w")
-                tk.Label(table_frame, text=book['title'], font=("Helvetica", 12), bg="#f7f7f7", fg="#555").grid(row=i + 1, column=1, padx=10, pady=5, sticky="w")
-                tk.Label(table_frame, text=book['borrowed_date'], font=("Helvetica", 12), bg="#f7f7f7", fg="#555").grid(row=i + 1, column=2, padx=10, pady=5, sticky="w")
-                tk.Label(table_frame, text=book['due_date'], font=("Helvetica", 12), bg="#f7f7f7", fg="#555").grid(row=i + 1, column=3, padx=10, pady=5, sticky="w")
-
-                action_button = Button(
-                    table_frame,
-                    text="Return Book",
-                    font=("Helvetica", 12),
-                    bg="#FF5722",
-                    fg="white",
-                    command=lambda b=book: self.return_book(b),  # Function to return the book
-                    borderless=1
-                )
-                action_button.grid(row=i + 1, column=4, padx=10, pady=5, sticky="w")
+            def display_borrowed_books(response):
+                borrowed_books = response.get("borrowed_books", [])
+                for i, book in enumerate(borrowed_books):
+                    tk.Label(table_frame, text=book['book_id'], font=("Helvetica", 12), bg="#f7f7f7", fg="#555").grid(row=i + 1, column=0, padx=10, pady=5, sticky="w")
+                    tk.Label(table_frame, text=book['title'], font=("Helvetica", 12), bg="#f7f7f7", fg="#555").grid(row=i + 1, column=1, padx=10, pady=5, sticky="w")
+                    tk.Label(table_frame, text=book['borrowed_date'], font=("Helvetica", 12), bg="#f7f7f7", fg="#555").grid(row=i + 1, column=2, padx=10, pady=5, sticky="w")
+                    tk.Label(table_frame, text=book['due_date'], font=("Helvetica", 12), bg="#f7f7f7", fg="#555").grid(row=i + 1, column=3, padx=10, pady=5, sticky="w")
+
+                    action_button = Button(
+                        table_frame,
+                        text="Return Book",
+                        font=("Helvetica", 12),
+                        bg="#FF5722",
+                        fg="white",
+                        command=lambda b=book: self.return_book(b),  # Function to return the book
+                        borderless=1
+                    )
+                    action_button.grid(row=i + 1, column=4, padx=10, pady=5, sticky="w")
+
+            # Fetch the books the current user has borrowed right now from Microservice B
+            self.caller.cached_request(5556, "get_borrowed_books", self.current_user, display_borrowed_books)
 
             # Back button
             Button(self.root, text="Back", font=("Helvetica", 14), bg="#FF5722", fg="white", command=self.show_book_list_screen, borderless=1).pack(pady=20)
@@ -243,10 +306,6 @@ class LibraryApp:
         print(f"Fetching borrowing history for user: {self.current_user}")
         tk.Label(self.root, text="Borrowing History", font=("Helvetica", 24, "bold"), bg="#f7f7f7", fg="#333").pack(pady=20)
 
-        # Fetch the borrowing history for the current user
-        response = communicate_with_microservice(5558, "get_borrowing_history", self.current_user)
-        borrowed_books = response.get("borrowed_books", [])
-
         # Display borrowing history in a table
         table_frame = tk.Frame(self.root, bg="#f7f7f7")
         table_frame.pack(pady=10, fill="both", expand=True)
@@ -254,15 +313,22 @@ class LibraryApp:
         tk.Label(table_frame, text="Book Name", font=("Helvetica", 14, "bold"), bg="#f7f7f7", fg="#333").grid(row=0, column=0, padx=10, pady=5, sticky="w")
         tk.Label(table_frame, text="Borrowed Date", font=("Helvetica", 14, "bold"), bg="#f7f7f7", fg="#333").grid(row=0, column=1, padx=10, pady=5, sticky="w")
 
-        for i, book in enumerate(borrowed_books):
-            tk.Label(table_frame, text=book['title'], font=("Helvetica", 12), bg="#f7f7f7", fg="#555").grid(row=i + 1, column=0, padx=10, pady=5, sticky="w")
-            tk.Label(table_frame, text=book['borrowed_date'], font=("Helvetica", 12), bg="#f7f7f7", fg="#555").grid(row=i + 1, column=1, padx=10, pady=5, sticky="w")
+        def display_history(response):
+            borrowed_books = response.get("borrowed_books", [])
+            for i, book in enumerate(borrowed_books):
+                tk.Label(table_frame, text=book['title'], font=("Helvetica", 12), bg="#f7f7f7", fg="#555").grid(row=i + 1, column=0, padx=10, pady=5, sticky="w")
+                tk.Label(table_frame, text=book['borrowed_date'], font=("Helvetica", 12), bg="#f7f7f7", fg="#555").grid(row=i + 1, column=1, padx=10, pady=5, sticky="w")
+
+        # Fetch the borrowing history for the current user
+        self.caller.cached_request(5558, "get_borrowing_history", self.current_user, display_history)
 
         # Back button
         Button(self.root, text="Back", font=("Helvetica", 14), bg="#FF5722", fg="white", command=self.show_book_list_screen, borderless=1).pack(pady=20)
-    def show_overdue_alerts(self):
-        """Check and display overdue books for the current user."""
-        response = communicate_with_microservice(5556, "check_overdue_books", self.current_user)
+    def show_overdue_alerts(self, response=None):
+        """Check and display overdue books for the current user, unless the response is already known."""
+        if response is None:
+            self.caller.request(5556, "check_overdue_books", self.current_user, self.show_overdue_alerts, screen=False)
+            return
 
         if response.get("status") == "alert":
             overdue_books = response.get("overdue_books", [])
@@ -274,21 +340,31 @@ class LibraryApp:
             messagebox.showerror("Error", response.get("message", "Failed to fetch overdue alerts."))
 
     def return_book(self, book):
-        """Return a borrowed book and update both Microservice D and Microservice C."""
-        user_id = self.current_user
-        # First call Microservice D to mark the book as available (return it)
-        response_d = communicate_with_microservice(5557, "return_book", book["book_id"])  # Use port 5557 for Microservice D
-        if response_d.get("status") == "success":
-            # Now call Microservice B to update the borrowing history
-            return_data = {"user_id": user_id, "book_id": book["book_id"]}
-            response_c = communicate_with_microservice(5556, "return_book", return_data)  # Use port 5558 for Microservice C
-            if response_c.get("status") == "success":
+        """Return a borrowed book through the coordinator, which updates Microservices B and D together."""
+        def on_response(response):
+            self.invalidate_after_change()
+            if response.get("status") == "success":
                 messagebox.showinfo("Success", f"You have returned '{book['title']}'!")
+                if book["book_id"] in self.user_borrowed_books:
+                    self.user_borrowed_books.remove(book["book_id"])
                 self.show_book_list_screen()  # Refresh the book list after returning the book
+            elif response.get("status") == "pending":
+                # Finished by the coordinator later; Microservice B's event drops the book from the list then
+                messagebox.showinfo("Return pending", response.get("message", "Your return will be completed shortly."))
             else:
-                messagebox.showerror("Error", response_c.get("message", "Failed to update borrowing history."))
-        else:
-            messagebox.showerror("Error", response_d.get("message", "Failed to return the book in Microservice D."))
+                messagebox.showerror("Error", response.get("message", "Failed to return the book."))
+
+        # Not cancelled by navigation, so the result is always reported
+        self.caller.request(5559, "return_book", {
+            "user_id": self.current_user,
+            "book_id": book["book_id"],
+        }, on_response, screen=False, request_id=uuid.uuid4().hex)  # Use port 5559 for Microservice E
+
+    def invalidate_after_change(self):
+        """Drop cached catalog and history replies after this client borrowed, reserved or returned a book."""
+        self.caller.cache.invalidate(5557)
+        self.caller.cache.invalidate(5556, "get_borrowed_books", self.current_user)
+        self.caller.cache.invalidate(5558, "get_borrowing_history", self.current_user)
 
     def show_book_list_screen(self):
         """Show the book list screen."""
@@ -309,12 +385,15 @@ class LibraryApp:
         search_entry.pack(side="left", padx=5)
 
         # Search Button
+        pending_search = []  # The in-flight search, superseded by a newer one
+
         def search_books():
             """Fetch and display books based on the search query."""
             query = search_var.get()
-            response = communicate_with_microservice(5557, "search_books", query)
-            books = response.get("books", [])
-            display_books(books)
+            for call in pending_search:
+                call.cancel()
+            pending_search[:] = [self.caller.cached_request(5557, "search_books", query,
+                                                     lambda response: display_books(response.get("books", [])))]
 
         search_button = Button(
             search_frame,
@@ -327,111 +406,157 @@ class LibraryApp:
         )
         search_button.pack(side="left", padx=5)
 
+        # Borrows or reserves the selected row (double-click or Enter on a row does the same)
+        Button(
+            search_frame,
+            text="Borrow / Reserve",
+            font=("Helvetica", 14),
+            bg="#FF9800",
+            fg="white",
+            command=lambda: act_on_selected(),
+            borderless=1
+        ).pack(side="left", padx=5)
 
-        # Table Headers
-        table_frame = tk.Frame(self.root, bg="#f7f7f7")
-        table_frame.pack(pady=10, fill="both", expand=True)
 
-        tk.Label(table_frame, text="Book Name", font=("Helvetica", 14, "bold"), bg="#f7f7f7", fg="#333").grid(row=0, column=0, padx=10, pady=5, sticky="w")
-        tk.Label(table_frame, text="Author Name", font=("Helvetica", 14, "bold"), bg="#f7f7f7", fg="#333").grid(row=0, column=1, padx=10, pady=5, sticky="w")
-        tk.Label(table_frame, text="Action", font=("Helvetica", 14, "bold"), bg="#f7f7f7", fg="#333").grid(row=0, column=2, padx=10, pady=5, sticky="w")
+        # Book table: a Treeview only draws the visible rows, and rows are updated in place
+        table_frame = tk.Frame(self.root, bg="#f7f7f7")
+        table_frame.pack(pady=10, fill="both", expand=True, padx=10)
+
+        tree = ttk.Treeview(table_frame, columns=("title", "author", "action"), show="headings", selectmode="browse")
+        tree.heading("title", text="Book Name", anchor="w")
+        tree.heading("author", text="Author Name", anchor="w")
+        tree.heading("action", text="Action", anchor="w")
+        tree.column("action", width=120, stretch=False)
+        tree.tag_configure("borrowed", foreground="#BDBDBD")
+        tree.tag_configure("available", foreground="#4CAF50")
+        tree.tag_configure("reservable", foreground="#FF9800")
+        scrollbar = ttk.Scrollbar(table_frame, orient="vertical", command=tree.yview)
+        tree.configure(yscrollcommand=scrollbar.set)
+        tree.pack(side="left", fill="both", expand=True)
+        scrollbar.pack(side="right", fill="y")
+
+        shown_books = {}  # Row id -> book currently shown in that row
+        shown_values = {}  # Row id -> (values, tag) last written to the Treeview
+
+        def row_for(book):
+            """Return the column values and color tag for a book's row."""
+            if book["id"] in self.user_borrowed_books:
+                action, tag = "Borrowed", "borrowed"
+            elif book.get("held_for") == self.current_user:
+                action, tag = "Borrow (Held)", "available"
+            elif book["available"]:
+                action, tag = "Borrow Book", "available"
+            else:
+                # Book is not available (already borrowed), offer to reserve it
+                action, tag = "Reserve Book", "reservable"
+            return (book['title'], book['author'], action), tag
+
+        def update_row(book):
+            """Rewrite a single row if its contents changed."""
+            row_id = str(book["id"])
+            shown_books[row_id] = book
+            row = row_for(book)
+            if shown_values.get(row_id) != row:
+                values, tag = row
+                tree.item(row_id, values=values, tags=(tag,))
+                shown_values[row_id] = row
 
         def display_books(books):
-            """Display books in a table format."""
-            # Clear previous rows
-            for widget in table_frame.winfo_children():
-                if widget.grid_info()["row"] > 0:
-                    widget.destroy()
-
-            for i, book in enumerate(books):
-                tk.Label(table_frame, text=book['title'], font=("Helvetica", 12), bg="#f7f7f7", fg="#555").grid(row=i + 1, column=0, padx=10, pady=5, sticky="w")
-                tk.Label(table_frame, text=book['author'], font=("Helvetica", 12), bg="#f7f7f7", fg="#555").grid(row=i + 1, column=1, padx=10, pady=5, sticky="w")
-
-                if book["available"]:
-                    # Check if the user has already borrowed the book
-                    if book["id"] in self.user_borrowed_books:
-                        action_button = Button(
-                            table_frame,
-                            text="Borrowed",
-                            font=("Helvetica", 12),
-                            bg="#BDBDBD",
-                            fg="white",
-                            state="disabled",
-                            borderless=1
-                        )
-                    else:
-                        action_button = Button(
-                            table_frame,
-                            text="Borrow Book",
-                            font=("Helvetica", 12),
-                            bg="#4CAF50",
-                            fg="white",
-                            command=lambda b=book: borrow_book(b),
-                            borderless=1
-                        )
+            """Display books in the table, touching only the rows that changed."""
+            if not tree.winfo_exists():
+                return  # The user has already left this screen
+            row_ids = [str(book["id"]) for book in books]
+            wanted = set(row_ids)
+            stale = [row_id for row_id in tree.get_children() if row_id not in wanted]
+            if stale:
+                tree.delete(*stale)
+                for row_id in stale:
+                    del shown_books[row_id]
+                    del shown_values[row_id]
+
+            for book, row_id in zip(books, row_ids):
+                if row_id in shown_values:
+                    update_row(book)
                 else:
-                    # Book is not available (already borrowed), show "Reserve Book" if not borrowed by current user
-                    if book["id"] in self.user_borrowed_books:
-                        action_button = Button(
-                            table_frame,
-                            text="Borrowed",
-                            font=("Helvetica", 12),
-                            bg="#BDBDBD",
-                            fg="white",
-                            state="disabled",
-                            borderless=1
-                        )
-                    else:
-                        action_button = Button(
-                            table_frame,
-                            text="Reserve Book",
-                            font=("Helvetica", 12),
-                            bg="#FF9800",
-                            fg="white",
-                            command=lambda b=book: reserve_book(b),
-                            borderless=1
-                        )
-
-                action_button.grid(row=i + 1, column=2, padx=10, pady=5, sticky="w")
+                    values, tag = row_for(book)
+                    tree.insert("", "end", iid=row_id, values=values, tags=(tag,))
+                    shown_books[row_id] = book
+                    shown_values[row_id] = (values, tag)
+
+            # Only reorder when the order actually differs (e.g. ranked search results)
+            if list(tree.get_children()) != row_ids:
+                for index, row_id in enumerate(row_ids):
+                    tree.move(row_id, "", index)
+
+        def act_on_selected(event=None):
+            """Borrow or reserve the selected book, depending on its row."""
+            selection = tree.selection()
+            if not selection:
+                return
+            book = shown_books[selection[0]]
+            if book["id"] in self.user_borrowed_books:
+                return
+            if book["available"] or book.get("held_for") == self.current_user:
+                borrow_book(book)
+            else:
+                reserve_book(book)
 
-        def borrow_book(book):
-            """Borrow a book and update both Microservice D and Microservice B."""
+        def apply_book_event(event):
+            """Apply a change event from Microservice D to the book's row, if it is shown."""
+            if event["type"] == "catalog":
+                refresh_books()
+                return
+            book = shown_books.get(str(event["id"]))
+            if book is not None:
+                book["available"] = event["available"]
+                book["reserved"] = event["reserved"]
+                book["held_for"] = event.get("held_for")
+                update_row(book)
 
-           
-    
-            user_id = self.current_user
-            # Call Microservice D to mark the book as borrowed
-            response_d = communicate_with_microservice(5557, "borrow_book", book["id"])
-            if response_d.get("status") == "success":
-                response_b = communicate_with_microservice(5556, "borrow_book", {
-                    "user_id": user_id,
-                    "book_id": book["id"],
-                    "title": book["title"],
-                    "borrowed_date": "2024-11-02",  # Example date
-                    "due_date": (datetime.now() + timedelta(days=7)).strftime("%Y-%m-%d")
-                })
-                if response_b.get("status") == "success":
+        self.book_event_handler = apply_book_event
+
+        tree.bind("<Double-1>", act_on_selected)
+        tree.bind("<Return>", act_on_selected)
+
+        def borrow_book(book):
+            """Borrow a book through the coordinator, which updates Microservices D and B together."""
+            def on_response(response):
+                self.invalidate_after_change()
+                if response.get("status") == "success":
                     messagebox.showinfo("Success", f"You have borrowed '{book['title']}'!")
-                    refresh_books()
+                    # Only this book's availability changed, so update its row instead of re-fetching the catalog
+                    if book["id"] not in self.user_borrowed_books:
+                        self.user_borrowed_books.append(book["id"])
+                    book["available"] = False
+                    book["held_for"] = None
+                    if tree.winfo_exists():
+                        update_row(book)
                 else:
-                    messagebox.showerror("Error", response_b.get("message", "Failed to borrow book."))
-            else:
-                messagebox.showerror("Error", response_d.get("message", "Failed to borrow book."))
+                    messagebox.showerror("Error", response.get("message", "Failed to borrow book."))
+
+            self.caller.request(5559, "borrow_book", {
+                "user_id": self.current_user,
+                "book_id": book["id"],
+                "title": book["title"],
+            }, on_response, screen=False, request_id=uuid.uuid4().hex)  # Use port 5559 for Microservice E
 
         def reserve_book(book):
             """Reserve a book and update Microservice D."""
-            response = communicate_with_microservice(5557, "reserve_book", book["id"])
-            if response.get("status") == "success":
-                messagebox.showinfo("Success", f"You have reserved '{book['title']}'!")
-                refresh_books()  # Refresh the book list
-            else:
-                messagebox.showerror("Error", response.get("message", "Failed to reserve book."))
+            def on_response(response):
+                self.invalidate_after_change()
+                if response.get("status") == "success":
+                    messagebox.showinfo("Success", f"You have reserved '{book['title']}'! You are number {response['position']} in the queue.")
+                    refresh_books()  # Refresh the book list
+                else:
+                    messagebox.showerror("Error", response.get("message", "Failed to reserve book."))
+
+            self.caller.request(5557, "reserve_book", {"book_id": book["id"], "user_id": self.current_user}, on_response, screen=False,
+                                request_id=uuid.uuid4().hex)
 
         def refresh_books():
             """Fetch and display updated book list."""
-            response = communicate_with_microservice(5557, "get_books")
-            books = response.get("books", [])
-            display_books(books)
+            self.caller.cached_request(5557, "get_books", {"fields": BOOK_LIST_FIELDS},
+                                lambda response: display_books(response.get("books", [])))
 
 
         # Fetch and display all books initially
@@ -478,4 +603,11 @@ class LibraryApp:
 if __name__ == "__main__":
     root = tk.Tk()
     app = LibraryApp(root)
+
+    def on_close():
+        app.caller.shutdown()
+        root.destroy()
+
+    root.protocol("WM_DELETE_WINDOW", on_close)
     root.mainloop()
+    close_all()
@@ -0,0 +1,94 @@
+# Change notifications published by the microservices over ZeroMQ PUB/SUB
+import threading
+import zmq
+import codec
+
+# Each service publishes on its request port + 10
+EVENT_PORTS = {
+    5554: 5564,  # Microservice A
+    5556: 5566,  # Microservice B: borrow / return
+    5557: 5567,  # Microservice D: book availability and reservations
+    5558: 5568,  # Microservice C
+}
+
+# Topics
+BOOK_TOPIC = "book"
+BORROW_TOPIC = "borrow"
+HISTORY_TOPIC = "history"
+OVERDUE_TOPIC = "overdue"
+
+
+class EventPublisher:
+    """
+    PUB socket a service announces its changes on.
+    Messages are [topic, codec name, body] so subscribers can filter by topic prefix.
+    """
+
+    def __init__(self, port):
+        self.socket = zmq.Context.instance().socket(zmq.PUB)
+        self.socket.setsockopt(zmq.LINGER, 0)
+        self.socket.bind(f"tcp://*:{port}")
+        # Events are tiny, and JSON can be decoded by every subscriber
+        self.codec = codec.JSON
+        self._lock = threading.Lock()  # PUB sockets are not thread-safe
+
+    def publish(self, topic, event):
+        frames = [topic.encode()] + codec.encode_frames(event, self.codec)
+        with self._lock:
+            self.socket.send_multipart(frames)
+
+    def close(self):
+        self.socket.close()
+
+
+class NullPublisher:
+    """Stands in for EventPublisher until a service starts, so handlers can always publish."""
+
+    def publish(self, topic, event):
+        pass
+
+    def close(self):
+        pass
+
+
+class EventSubscriber:
+    """
+    Background thread receiving a service's change events.
+    Events published while disconnected are lost, so subscribers should keep a
+    fallback (e.g. a cache TTL) rather than rely on seeing every event.
+    """
+
+    def __init__(self, port, topics, on_event, host="localhost"):
+        """
+        :param port: The service's event port (see EVENT_PORTS).
+        :param topics: Topic prefixes to receive.
+        :param on_event: Called on the subscriber thread with (topic, event).
+        """
+        self.address = f"tcp://{host}:{port}"
+        self.topics = topics
+        self.on_event = on_event
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        socket = zmq.Context.instance().socket(zmq.SUB)
+        socket.setsockopt(zmq.LINGER, 0)
+        socket.connect(self.address)
+        for topic in self.topics:
+            socket.setsockopt(zmq.SUBSCRIBE, topic.encode())
+        try:
+            while not self._stopped.is_set():
+                if not socket.poll(200, zmq.POLLIN):
+                    continue
+                frames = socket.recv_multipart()
+                try:
+                    event, _ = codec.decode_frames(frames[1:])
+                except (KeyError, ValueError):
+                    continue  # Encoded with a codec this process lacks
+                self.on_event(frames[0].decode(), event)
+        finally:
+            socket.close()
+
+    def stop(self):
+        self._stopped.set()
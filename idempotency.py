@@ -0,0 +1,95 @@
+# Server-side deduplication of retried requests
+import copy
+import json
+import threading
+import time
+from collections import OrderedDict
+
+# Replies remembered per service, and for how many seconds
+DEFAULT_MAX_SIZE = 10000
+DEFAULT_TTL = 600
+# Status of the reply to a duplicate whose original is still running
+IN_PROGRESS = "in_progress"
+
+
+class _Entry:
+    def __init__(self, fingerprint):
+        self.fingerprint = fingerprint
+        self.response = None
+        self.expires = None  # Set once the response is known
+        self.done = threading.Event()
+
+
+class IdempotencyCache:
+    """
+    Remembers the reply to each request id, so a client that resends a request
+    after losing the reply gets the original reply instead of running it twice.
+    Bounded by size (least recently used ids are dropped first) and by age.
+    A duplicate arriving while the original is still running is answered with
+    an IN_PROGRESS reply at once, rather than holding a worker until it finishes;
+    the client resends it later.
+    """
+
+    def __init__(self, max_size=DEFAULT_MAX_SIZE, ttl=DEFAULT_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()  # request id -> _Entry, least recently used first
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def run(self, request_id, request, execute):
+        """
+        Run a request once per request id.
+        :param request_id: The client's id for this request.
+        :param request: The request itself.
+        :param execute: Function running the request and returning the reply.
+        :return: The reply, an IN_PROGRESS reply while the original is still running,
+                 or an error if the id was already used for a different request.
+        """
+        fingerprint = json.dumps(request, sort_keys=True, default=str)
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(request_id)
+            if entry is not None and entry.expires is not None and entry.expires <= now:
+                del self._entries[request_id]
+                entry = None
+            first = entry is None
+            if first:
+                entry = self._entries[request_id] = _Entry(fingerprint)
+            else:
+                self._entries.move_to_end(request_id)
+
+        if not first:
+            if entry.fingerprint != fingerprint:
+                return {"status": "error", "message": f"Request id {request_id} was already used for a different request"}
+            if not entry.done.is_set():
+                return {"status": IN_PROGRESS, "message": f"Request {request_id} is still running, please retry"}
+            return copy.deepcopy(entry.response)
+
+        try:
+            response = execute(request)
+            # Copied, since replies may reference live service state that changes later
+            entry.response = copy.deepcopy(response)
+            return response
+        finally:
+            with self._lock:
+                entry.expires = time.monotonic() + self.ttl
+                self._evict()
+            entry.done.set()
+
+    def _evict(self):
+        """Drop expired entries and, beyond max_size, the least recently used ones."""
+        now = time.monotonic()
+        while self._entries:
+            request_id, entry = next(iter(self._entries.items()))
+            if entry.expires is None:
+                break  # Still running; dropped on a later call
+            if entry.expires > now and len(self._entries) <= self.max_size:
+                break
+            del self._entries[request_id]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
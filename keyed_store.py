@@ -0,0 +1,69 @@
+# Keyed in-memory record store shared by the microservices
+
+
+class KeyedStore:
+    """
+    Insertion-ordered collection of dict records with O(1) lookups.
+    Records are unique on a primary key field; each secondary index field maps a
+    value to every record carrying it, so duplicates on that field are allowed.
+    Records missing a secondary field are simply left out of that index.
+    """
+
+    def __init__(self, key, *index_fields):
+        self.key = key
+        self._records = {}  # primary key -> record, in insertion order
+        self._indexes = {field: {} for field in index_fields}  # field -> value -> {primary key: record}
+
+    def __len__(self):
+        return len(self._records)
+
+    def __iter__(self):
+        return iter(self._records.values())
+
+    def __contains__(self, key):
+        return key in self._records
+
+    def values(self):
+        """Return all records as a list, in insertion order."""
+        return list(self._records.values())
+
+    def get(self, key):
+        """Return the record with the given primary key, or None."""
+        return self._records.get(key)
+
+    def get_by(self, field, value):
+        """Return the first record whose secondary field equals value, or None."""
+        matches = self._indexes[field].get(value)
+        if not matches:
+            return None
+        return next(iter(matches.values()))
+
+    def add(self, record):
+        """
+        Insert a record.
+        :return: False if a record with the same primary key already exists.
+        """
+        key = record[self.key]
+        if key in self._records:
+            return False
+        self._records[key] = record
+        for field, index in self._indexes.items():
+            if field in record:
+                index.setdefault(record[field], {})[key] = record
+        return True
+
+    def remove(self, record):
+        """Remove a record previously returned by this store."""
+        key = record[self.key]
+        del self._records[key]
+        for field, index in self._indexes.items():
+            if field in record:
+                matches = index[record[field]]
+                del matches[key]
+                if not matches:
+                    del index[record[field]]
+
+    def clear(self):
+        self._records.clear()
+        for index in self._indexes.values():
+            index.clear()
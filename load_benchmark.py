@@ -0,0 +1,270 @@
+# Load and latency benchmark for the microservices
+# Usage: python load_benchmark.py --mix mixed --clients 16 --duration 10 --output results.json
+import argparse
+import json
+import math
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime
+from zmq_client import ServiceError, close_all, send_request
+
+# Service scripts, their ports and a cheap request that shows they are answering
+SERVICES = {
+    "a": ("micro_service_a_listener.py", 5554, [{'sign_in': True}, {"username": "", "password": ""}]),
+    "b": ("micro_service_b.py", 5556, ["check_overdue_books", -1]),
+    "c": ("micro_service_c.py", 5558, ["get_borrowing_history", {"user_id": -1, "limit": 1}]),
+    "d": ("micro_service_d.py", 5557, ["get_books", {"limit": 1}]),
+    "e": ("micro_service_e.py", 5559, ["ping", None]),
+}
+
+# Operation mixes: operation name -> relative weight
+MIXES = {
+    "signin": {"sign_in": 90, "get_books": 10},
+    "search": {"search_books": 80, "get_books": 20},
+    "churn": {"borrow_return": 100},
+    "history": {"get_history": 80, "get_borrowed_books": 20},
+    "mixed": {"sign_in": 20, "search_books": 40, "borrow_return": 20, "get_history": 20},
+}
+
+FIRST_USER_ID = 100000  # Benchmark users never collide with real ones
+FIRST_BOOK_ID = 100000  # Nor do benchmark books
+BOOKS_PER_CLIENT = 20  # Books each client borrows and returns, so clients never contend
+PASSWORD = "benchmark"
+WORDS = ["river", "shadow", "garden", "empire", "winter", "glass", "silent", "ocean",
+         "iron", "paper", "storm", "golden", "hidden", "northern", "last", "secret"]
+REQUEST_TIMEOUT = 10
+
+
+def start_services(names, workers):
+    """
+    Start each service in its own process with in-memory storage.
+    :return: The list of processes.
+    """
+    env = dict(os.environ, STORAGE_BACKEND="memory")
+    if workers is not None:
+        env["SERVICE_WORKERS"] = str(workers)
+    directory = os.path.dirname(os.path.abspath(__file__))
+    processes = []
+    for name in names:
+        script = SERVICES[name][0]
+        processes.append(subprocess.Popen([sys.executable, os.path.join(directory, script)], env=env, cwd=tempfile.gettempdir(),
+                                          stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL))
+    for name in names:
+        wait_until_ready(name)
+    return processes
+
+
+def wait_until_ready(name, timeout=15):
+    _, port, probe = SERVICES[name]
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            send_request(port, probe, timeout=0.5)
+            return
+        except ServiceError:
+            if time.monotonic() > deadline:
+                raise ServiceError(f"Service {name.upper()} did not start on port {port}")
+
+
+def stop_services(processes):
+    for process in processes:
+        process.terminate()
+    for process in processes:
+        process.wait()
+
+
+def book_title(rng):
+    return " ".join(rng.choice(WORDS).title() for _ in range(3))
+
+
+def setup(clients, catalog_size, seed):
+    """Create the benchmark users in A and a synthetic catalog in D."""
+    rng = random.Random(seed)
+    for i in range(clients):
+        send_request(5554, [{'sign_up': True}, {"username": f"bench{i}", "password": PASSWORD, "id": FIRST_USER_ID + i}],
+                     timeout=REQUEST_TIMEOUT)
+    catalog_size = max(catalog_size, clients * BOOKS_PER_CLIENT)
+    books = [{"id": FIRST_BOOK_ID + i, "title": book_title(rng), "author": f"{rng.choice(WORDS).title()} Author"}
+             for i in range(catalog_size)]
+    for start in range(0, len(books), 5000):
+        final = start + 5000 >= len(books)
+        send_request(5557, ["bulk_load_books", {"books": books[start:start + 5000], "final": final}],
+                     timeout=REQUEST_TIMEOUT)
+    return catalog_size
+
+
+class Client:
+    """One simulated user sending requests back to back."""
+
+    def __init__(self, index, catalog_size, seed):
+        self.index = index
+        self.user_id = FIRST_USER_ID + index
+        self.catalog_size = catalog_size
+        self.rng = random.Random(seed * 1000 + index)
+        self.own_books = [FIRST_BOOK_ID + index * BOOKS_PER_CLIENT + k for k in range(BOOKS_PER_CLIENT)]
+        self.borrowed = []
+
+    def request(self, operation):
+        """:return: (operation name to record, port, request)."""
+        if operation == "sign_in":
+            return operation, 5554, [{'sign_in': True}, {"username": f"bench{self.index}", "password": PASSWORD}]
+        if operation == "search_books":
+            query = self.rng.choice(WORDS)[:self.rng.randint(3, 6)]
+            return operation, 5557, ["search_books", {"query": query, "limit": 20}]
+        if operation == "get_books":
+            offset = self.rng.randrange(self.catalog_size)
+            return operation, 5557, ["get_books", {"offset": offset, "limit": 50, "fields": ["id", "title", "author", "available"]}]
+        if operation == "get_history":
+            return operation, 5558, ["get_borrowing_history", {"user_id": self.user_id, "limit": 20}]
+        if operation == "get_borrowed_books":
+            return operation, 5556, ["get_borrowed_books", self.user_id]
+        if operation == "borrow_return":
+            # Borrow until holding a few books, then return, so each loan is churned
+            if self.borrowed and (len(self.borrowed) >= 3 or self.rng.random() < 0.5):
+                book_id = self.borrowed.pop(0)
+                return "return_book", 5559, ["return_book", {"user_id": self.user_id, "book_id": book_id}]
+            book_id = next(book for book in self.own_books if book not in self.borrowed)
+            self.borrowed.append(book_id)
+            return "borrow_book", 5559, ["borrow_book", {"user_id": self.user_id, "book_id": book_id, "title": "Benchmark"}]
+        raise ValueError(f"Unknown operation: {operation}")
+
+    def run(self, mix, warmup_end, end, samples):
+        """Send requests until end, recording (operation, seconds, ok) after warmup_end."""
+        operations, weights = list(mix), list(mix.values())
+        while time.monotonic() < end:
+            name, port, request = self.request(self.rng.choices(operations, weights)[0])
+            start = time.monotonic()
+            try:
+                reply = send_request(port, request, timeout=REQUEST_TIMEOUT)
+                ok = not (isinstance(reply, dict) and reply.get("status") == "error")
+            except ServiceError:
+                ok = False
+            finished = time.monotonic()
+            if start >= warmup_end:
+                samples.append((name, finished - start, ok))
+
+
+def server_stats():
+    """Each service's own request metrics (see the stats operation), or None if it did not answer."""
+    stats = {}
+    for name, (_, port, _) in SERVICES.items():
+        try:
+            stats[name] = send_request(port, ["stats", None], timeout=REQUEST_TIMEOUT)
+        except ServiceError:
+            stats[name] = None
+    return stats
+
+
+def percentile(sorted_values, fraction):
+    """Nearest-rank percentile of an already sorted list."""
+    if not sorted_values:
+        return None
+    rank = math.ceil(fraction * len(sorted_values))
+    return sorted_values[max(rank, 1) - 1]
+
+
+def summarize(samples, seconds):
+    """Per-operation (and total) throughput and latency, latencies in milliseconds."""
+    by_operation = {}
+    for name, latency, ok in samples:
+        by_operation.setdefault(name, []).append((latency, ok))
+    by_operation["total"] = [(latency, ok) for _, latency, ok in samples]
+
+    results = {}
+    for name, values in by_operation.items():
+        latencies = sorted(latency * 1000 for latency, _ in values)
+        results[name] = {
+            "count": len(values),
+            "errors": sum(1 for _, ok in values if not ok),
+            "throughput": len(values) / seconds if seconds else 0,
+            "mean_ms": sum(latencies) / len(latencies) if latencies else None,
+            "p50_ms": percentile(latencies, 0.50),
+            "p95_ms": percentile(latencies, 0.95),
+            "p99_ms": percentile(latencies, 0.99),
+            "max_ms": latencies[-1] if latencies else None,
+        }
+    return results
+
+
+def print_results(results, baseline=None):
+    """Print a table, with the change from a baseline run's results if given."""
+    def cell(value):
+        return f"{value:>9.2f}" if value is not None else f"{'-':>9}"
+
+    print(f"{'operation':<20} {'count':>8} {'errors':>7} {'req/s':>9} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}")
+    for name in sorted(results, key=lambda name: (name == "total", name)):
+        stats = results[name]
+        print(f"{name:<20} {stats['count']:>8} {stats['errors']:>7} {cell(stats['throughput'])} "
+              f"{cell(stats['p50_ms'])} {cell(stats['p95_ms'])} {cell(stats['p99_ms'])}")
+        old = (baseline or {}).get(name)
+        if old:
+            changes = []
+            for key in ("throughput", "p50_ms", "p95_ms", "p99_ms"):
+                if old.get(key) and stats.get(key) is not None:
+                    changes.append(f"{key} {100 * (stats[key] - old[key]) / old[key]:+.1f}%")
+            print(f"{'  vs baseline':<20} {', '.join(changes)}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Drive the microservices with concurrent clients and report latency.")
+    parser.add_argument("--mix", choices=sorted(MIXES), default="mixed")
+    parser.add_argument("--clients", type=int, default=8, help="Concurrent clients")
+    parser.add_argument("--duration", type=float, default=10, help="Seconds to measure")
+    parser.add_argument("--warmup", type=float, default=1, help="Seconds to run before measuring")
+    parser.add_argument("--workers", type=int, help="SERVICE_WORKERS for the started services")
+    parser.add_argument("--catalog-size", type=int, default=10000, help="Synthetic books loaded into Service D")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--no-start", action="store_true", help="Use services that are already running")
+    parser.add_argument("--output", help="Write the results to this JSON file")
+    parser.add_argument("--baseline", help="Compare with the results JSON of an earlier run")
+    args = parser.parse_args()
+
+    processes = [] if args.no_start else start_services(sorted(SERVICES), args.workers)
+    try:
+        catalog_size = setup(args.clients, args.catalog_size, args.seed)
+        clients = [Client(i, catalog_size, args.seed) for i in range(args.clients)]
+        samples = []  # list.append is atomic, so clients share it
+        warmup_end = time.monotonic() + args.warmup
+        end = warmup_end + args.duration
+        threads = [threading.Thread(target=client.run, args=(MIXES[args.mix], warmup_end, end, samples))
+                   for client in clients]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        services = server_stats()
+    finally:
+        close_all()
+        stop_services(processes)
+
+    results = summarize(samples, args.duration)
+    baseline = None
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)["operations"]
+    print_results(results, baseline)
+
+    if args.output:
+        report = {
+            "date": datetime.now().isoformat(timespec="seconds"),
+            "mix": args.mix,
+            "clients": args.clients,
+            "duration": args.duration,
+            "workers": args.workers,
+            "catalog_size": catalog_size,
+            "seed": args.seed,
+            "codec": os.environ.get("SERVICE_CODEC"),
+            "operations": results,
+            "server_stats": services,
+        }
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,75 @@
+# Bounded, id-addressed message log for Microservice A
+import itertools
+import time
+from collections import deque
+
+
+class MessageLog:
+    """
+    Capped log of messages, oldest first. Each message gets the next id in an
+    unbroken sequence, so readers page with "everything after the last id I saw".
+    Messages beyond max_messages, or older than max_age seconds, are dropped
+    from the front.
+    """
+
+    def __init__(self, max_messages, max_age=None):
+        """
+        :param max_messages: Most messages kept.
+        :param max_age: Seconds a message is kept, or None to keep messages until the log is full.
+        """
+        self.max_messages = max_messages
+        self.max_age = max_age
+        self._records = deque()  # {"message_id", "time", "message"}, ids ascending and contiguous
+        self._next_id = 0
+
+    def __len__(self):
+        return len(self._records)
+
+    def oldest_id(self):
+        """Id of the oldest message still kept, or of the next one if the log is empty."""
+        return self._records[0]["message_id"] if self._records else self._next_id
+
+    def next_id(self):
+        """Id the next message will get."""
+        return self._next_id
+
+    def skip_to(self, next_id):
+        """Continue numbering at next_id, e.g. after a restart that found the log empty."""
+        self._next_id = max(self._next_id, next_id)
+
+    def restore(self, record):
+        """Re-add a record loaded from storage; records must be restored in id order."""
+        self._records.append(record)
+        self._next_id = record["message_id"] + 1
+
+    def append(self, message, now=None):
+        """
+        Add a message.
+        :return: (the new record, ids of the messages dropped to make room).
+        """
+        record = {"message_id": self._next_id, "time": time.time() if now is None else now, "message": message}
+        self._next_id += 1
+        self._records.append(record)
+        return record, self.trim(record["time"])
+
+    def trim(self, now=None):
+        """
+        Drop messages beyond the retention limits.
+        :return: The ids of the dropped messages.
+        """
+        now = time.time() if now is None else now
+        dropped = []
+        while self._records and (len(self._records) > self.max_messages or
+                                 (self.max_age is not None and self._records[0]["time"] < now - self.max_age)):
+            dropped.append(self._records.popleft()["message_id"])
+        return dropped
+
+    def since(self, since_id, limit):
+        """
+        Page through the log.
+        :param since_id: Return messages with a greater id; None for the oldest kept.
+        :param limit: Most messages returned.
+        :return: The records, oldest first.
+        """
+        start = 0 if since_id is None else max(since_id + 1 - self.oldest_id(), 0)
+        return list(itertools.islice(self._records, start, start + limit))
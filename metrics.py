@@ -0,0 +1,181 @@
+# Request metrics collected by every service's dispatch loop
+import bisect
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Set to 1 to serve the metrics in Prometheus text format over HTTP on the service's port + 1000
+HTTP_ENV = "METRICS_HTTP"
+HTTP_PORT_OFFSET = 1000
+
+# Upper bounds of the latency histogram buckets, in seconds
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+
+
+class OperationStats:
+    """Counters for one operation. Times are in seconds, sizes in bytes."""
+
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.buckets = [0] * (len(LATENCY_BUCKETS) + 1)  # The last bucket is +Inf
+        self.handle_seconds = 0.0  # Running the handler
+        self.wait_seconds = 0.0  # Queued behind other requests for the service lock
+        self.decode_seconds = 0.0
+        self.encode_seconds = 0.0
+        self.request_bytes = 0
+        self.reply_bytes = 0
+
+    def quantile(self, fraction):
+        """Estimate a latency quantile as the upper bound of the bucket it falls in."""
+        rank = fraction * self.count
+        seen = 0
+        for bound, count in zip(LATENCY_BUCKETS, self.buckets):
+            seen += count
+            if seen >= rank:
+                return bound
+        return None  # Beyond the largest bucket
+
+    def to_dict(self):
+        def ms(seconds):
+            return seconds * 1000 if seconds is not None else None
+
+        return {
+            "count": self.count,
+            "errors": self.errors,
+            "handle_seconds": self.handle_seconds,
+            "wait_seconds": self.wait_seconds,
+            "decode_seconds": self.decode_seconds,
+            "encode_seconds": self.encode_seconds,
+            "request_bytes": self.request_bytes,
+            "reply_bytes": self.reply_bytes,
+            "mean_ms": ms(self.handle_seconds / self.count) if self.count else None,
+            "p50_ms": ms(self.quantile(0.50)),
+            "p95_ms": ms(self.quantile(0.95)),
+            "p99_ms": ms(self.quantile(0.99)),
+        }
+
+
+class ServiceMetrics:
+    """
+    Per-operation request counters, latency histograms, payload sizes and
+    serialization times for one service, plus how many requests are in flight
+    and how many of those are queued for the service lock.
+    Recording costs one short lock hold per request.
+    """
+
+    def __init__(self, service=""):
+        self.service = str(service)
+        self.started = time.time()
+        self.operations = {}  # operation name -> OperationStats
+        self.in_flight = 0
+        self.waiting = 0
+        self._lock = threading.Lock()
+
+    def request_started(self):
+        with self._lock:
+            self.in_flight += 1
+            self.waiting += 1
+
+    def request_running(self):
+        """The request got past the service lock (or there is none)."""
+        with self._lock:
+            self.waiting -= 1
+
+    def request_finished(self, operation, error, timings, request_bytes, reply_bytes):
+        """
+        Record a finished request.
+        :param timings: (decode, wait, handle, encode) seconds.
+        """
+        decode, wait, handle, encode = timings
+        with self._lock:
+            self.in_flight -= 1
+            stats = self.operations.get(operation)
+            if stats is None:
+                stats = self.operations[operation] = OperationStats()
+            stats.count += 1
+            stats.errors += error
+            stats.buckets[bisect.bisect_left(LATENCY_BUCKETS, handle)] += 1
+            stats.handle_seconds += handle
+            stats.wait_seconds += wait
+            stats.decode_seconds += decode
+            stats.encode_seconds += encode
+            stats.request_bytes += request_bytes
+            stats.reply_bytes += reply_bytes
+
+    def stats(self):
+        """Return a snapshot of every counter, as sent in reply to the stats operation."""
+        with self._lock:
+            return {
+                "status": "success",
+                "service": self.service,
+                "uptime_seconds": time.time() - self.started,
+                "in_flight": self.in_flight,
+                "waiting": self.waiting,
+                "operations": {name: stats.to_dict() for name, stats in self.operations.items()},
+            }
+
+    def prometheus_text(self):
+        """Render the counters in the Prometheus text exposition format."""
+        service = self.service
+        lines = [
+            "# TYPE service_in_flight gauge",
+            f'service_in_flight{{service="{service}"}} {self.in_flight}',
+            "# TYPE service_waiting gauge",
+            f'service_waiting{{service="{service}"}} {self.waiting}',
+        ]
+        with self._lock:
+            operations = {name: (stats.to_dict(), list(stats.buckets)) for name, stats in self.operations.items()}
+
+        counters = [
+            ("service_requests_total", "count"),
+            ("service_request_errors_total", "errors"),
+            ("service_wait_seconds_total", "wait_seconds"),
+            ("service_decode_seconds_total", "decode_seconds"),
+            ("service_encode_seconds_total", "encode_seconds"),
+            ("service_request_bytes_total", "request_bytes"),
+            ("service_reply_bytes_total", "reply_bytes"),
+        ]
+        for metric, key in counters:
+            lines.append(f"# TYPE {metric} counter")
+            for name, (stats, _) in operations.items():
+                lines.append(f'{metric}{{service="{service}",operation="{name}"}} {stats[key]}')
+
+        lines.append("# TYPE service_request_duration_seconds histogram")
+        for name, (stats, buckets) in operations.items():
+            labels = f'service="{service}",operation="{name}"'
+            cumulative = 0
+            for bound, count in zip(LATENCY_BUCKETS + ("+Inf",), buckets):
+                cumulative += count
+                lines.append(f'service_request_duration_seconds_bucket{{{labels},le="{bound}"}} {cumulative}')
+            lines.append(f"service_request_duration_seconds_sum{{{labels}}} {stats['handle_seconds']}")
+            lines.append(f"service_request_duration_seconds_count{{{labels}}} {stats['count']}")
+        return "\n".join(lines) + "\n"
+
+
+def serve_http(metrics, port):
+    """Serve the metrics at http://localhost:<port>/metrics from a background thread."""
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path != "/metrics":
+                self.send_error(404)
+                return
+            body = metrics.prometheus_text().encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass  # Scrapes are too frequent to log
+
+    server = ThreadingHTTPServer(("localhost", port), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def http_enabled():
+    return os.environ.get(HTTP_ENV, "").lower() in ("1", "true", "yes")
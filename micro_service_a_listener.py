@@ -3,137 +3,311 @@
 # 11/18/24
 
 
-def lms_microservice():
-    print('LMS MICROSERVICE is running....')
-    import zmq
-    import json
-
-    context = zmq.Context()
-    socket = context.socket(zmq.REP)
-    socket.bind("tcp://*:5554")
-
-    users = []
-    books = []
-    messages = []
-
-    while True:
-        message = socket.recv()
-        data = json.loads(message.decode())
-        print(f"Received: {message}")
-        operation = data[0]
-        user_operations = [{'sign_up': True},
-                           {'sign_in': True},
-                           {'delete_user_id': True}
-                           ]
-        book_operations = [{'store_book': True},
-                           {'borrow_book': True},
-                           {'delete_book_id': True},
-                           {'return_book': True},
-                           {'delete_all_books': True}
-                           ]
-
-        # User Authentication
-        if operation in user_operations:
-            user = data[1]
-            reply = user_authentication(operation, user, users)
-
-        # Books CRUD Operations
-        elif operation in book_operations:
-            book = data[1]
-            reply = book_ops(operation, book, books)
-
-        # Message storing
-        else:
-            new_message = data[0]
-            messages.append(new_message)
-            reply = messages
-
-        response = json.dumps(reply)
-        socket.send(response.encode())
-        print(f'Response: {response}')
-        print(f"users:\n {users}")
-        print(f"books:\n {books}")
-        print()
-
-
-def user_authentication(operation, user, users):
-    # Add user
-    if operation == {'sign_up': True}:
-        print(f'USER SIGN UP')
-        new_user = user
-        for user in users:
-            if new_user['username'] == user['username']:
-                return [{'sign_up': 'username already exists'}]
-        else:
-            users.append(new_user)
-            print(f'user login successful: {new_user["username"]}')
-            return users
-
-    # Authenticate user
-    elif operation == {'sign_in': True}:
-        print('USER SIGN IN')
-        auth_user = user
-        for user in users:
-            if auth_user['username'] == user['username'] and auth_user['password'] == user['password']:
-                return [{'sign_in': True}]
-        else:
-            return [{'sign_in': False}]
-
-    # Delete user
-    elif operation == {'delete_user_id': True}:
-        print('DELETE USER')
-        user_id = user
-        for user in users:
-            if user['id'] == user_id:
-                users.remove(user)
-                return users
-        return [{'delete_user_id': 'user id not found'}]
-
-
-def book_ops(operation, book, books):
-    # Add book
-    if operation == {'store_book': True}:
-        print('STORE BOOK')
-        new_book = book
-        for book in books:
-            if new_book['title'] == book['title']:
-                return [{'store_book': 'book name already exists'}]
+import os
+import threading
+import time
+from keyed_store import KeyedStore
+from message_log import MessageLog
+from service_logging import configure_logging, fields, get_logger
+from storage import MemoryStorage, open_storage
+from zmq_server import serve
+
+log = get_logger('micro_service_a')
+
+users = KeyedStore('username', 'id')  # username -> user, also indexed by id
+books = KeyedStore('title', 'id')  # title -> book, also indexed by id
+# Messages kept, and for how many seconds (0 keeps them until the log is full)
+MESSAGE_RETENTION = int(os.environ.get('MESSAGE_RETENTION', '10000'))
+MESSAGE_MAX_AGE = float(os.environ.get('MESSAGE_MAX_AGE', '0'))
+# Messages returned by get_messages when no limit is given, and at most
+DEFAULT_MESSAGE_LIMIT = 100
+MAX_MESSAGE_LIMIT = 1000
+
+messages = MessageLog(MESSAGE_RETENTION, MESSAGE_MAX_AGE or None)
+storage = MemoryStorage()  # Replaced by the configured backend in load_state()
+
+# Held around each request so worker threads never see half-applied updates
+state_lock = threading.Lock()
+
+
+def lms_microservice(workers=None):
+    configure_logging('micro_service_a')
+    load_state()
+    log.info('LMS MICROSERVICE is running....', extra=fields(users=len(users), books=len(books)))
+    try:
+        serve(5554, handle_request, workers, state_lock, operations=operations)
+    finally:
+        storage.close()
+
+
+def load_state():
+    """Open the configured storage backend and reload users, books and messages from it."""
+    global storage
+    storage = open_storage('micro_service_a')
+    state = storage.load()
+    for user in state.get('users', []):
+        users.add(user)
+    for book in state.get('books', []):
+        books.add(book)
+    for counter in state.get('message_ids', []):
+        messages.skip_to(counter['next_id'])
+    for key, record in enumerate(state.get('messages', [])):
+        if not (isinstance(record, dict) and 'message_id' in record and 'message' in record):
+            # Stored before messages had ids, under their position in the list
+            record = {'message_id': key, 'time': time.time(), 'message': record}
+            storage.put('messages', key, record)
+        messages.restore(record)
+    forget_messages(messages.trim())
+
+
+def forget_messages(message_ids):
+    """Delete dropped messages from storage, remembering the next id if none are left to carry it."""
+    for message_id in message_ids:
+        storage.delete('messages', message_id)
+    if message_ids and not len(messages):
+        storage.put('message_ids', 'next', {'next_id': messages.next_id()})
+
+
+# Registered operations: normalized name -> (handler, compiled payload check, payload used when none is sent)
+operations = {}
+
+
+def compile_schema(schema):
+    """
+    Turn a payload schema into a check function, once, at registration.
+    A schema is None (anything goes), a type, [schema] (a list of matching items)
+    or a dict of field -> schema for required fields, where a field name ending
+    in '?' is optional. Fields not named in the schema are allowed.
+    :return: Function taking a payload and returning an error message, or None if it is valid.
+    """
+    if schema is None:
+        return lambda value: None
+
+    if isinstance(schema, type):
+        name = schema.__name__
+        if schema is int:
+            # bool is a subclass of int, but True is not an id
+            return lambda value: None if isinstance(value, int) and not isinstance(value, bool) else f'expected {name}'
+        return lambda value: None if isinstance(value, schema) else f'expected {name}'
+
+    if isinstance(schema, list):
+        check_item = compile_schema(schema[0])
+
+        def check_list(value):
+            if not isinstance(value, list):
+                return 'expected list'
+            for i, item in enumerate(value):
+                error = check_item(item)
+                if error:
+                    return f'item {i}: {error}'
+            return None
+        return check_list
+
+    field_checks = [(field.rstrip('?'), not field.endswith('?'), compile_schema(field_schema))
+                     for field, field_schema in schema.items()]
+
+    def check_record(value):
+        if not isinstance(value, dict):
+            return 'expected dict'
+        for field, required, check_field in field_checks:
+            if field not in value:
+                if required:
+                    return f'missing {field}'
+                continue
+            error = check_field(value[field])
+            if error:
+                return f'{field}: {error}'
+        return None
+    return check_record
+
+
+def operation(name, schema=None, default=None):
+    """
+    Register the decorated function as the handler of an operation whose payload matches schema.
+    :param default: Payload to use when the request has none, for operations whose fields are all optional.
+    """
+    check = compile_schema(schema)
+
+    def register(handler):
+        operations[name] = (handler, check, default)
+        return handler
+    return register
+
+
+def operation_key(operation):
+    """
+    Normalize an operation to its registered name. Clients name operations like
+    {'sign_in': True}; a plain 'sign_in' is accepted too.
+    :return: The name, or None if the operation is not in either form.
+    """
+    if isinstance(operation, str):
+        return operation
+    if isinstance(operation, dict) and len(operation) == 1:
+        name, flag = next(iter(operation.items()))
+        if flag is True:
+            return name
+    return None
+
+
+USER_SCHEMA = {'username': str, 'password': str, 'id?': int, 'email?': str}
+CREDENTIALS_SCHEMA = {'username': str, 'password': str}
+BOOK_SCHEMA = {'title': str, 'id?': int, 'available?': bool}
+
+
+def handle_request(data):
+    if not isinstance(data, list) or not data:
+        return [{'error': 'malformed request'}]
+    name = operation_key(data[0])
+    if len(data) == 1 and name not in operations:
+        # A lone message, e.g. [{'key1': 'valueA'}]
+        name, payload = 'store_message', data[0]
+    else:
+        payload = data[1] if len(data) > 1 else None
+
+    registered = operations.get(name)
+    if registered is None:
+        return [{'error': 'unknown operation'}]
+    handler, check, default = registered
+    if payload is None and default is not None:
+        payload = default
+    error = check(payload)
+    if error:
+        # Under 'error', never under the operation's own key, where callers test for success
+        return [{'error': f'invalid {name} request: {error}'}]
+    reply = handler(payload)
+
+    # Counts only: formatting the request, reply or stores would cost O(n) per request
+    log.debug('Request handled', extra=fields(operation=name, users=len(users), books=len(books)))
+    return reply
+
+
+# User Authentication
+
+@operation('sign_up', USER_SCHEMA)
+def sign_up(new_user):
+    if not users.add(new_user):
+        return [{'sign_up': 'username already exists'}]
+    storage.put('users', new_user['username'], new_user)
+    log.info('User signed up', extra=fields(username=new_user['username']))
+    return users.values()
+
+
+@operation('sign_in', CREDENTIALS_SCHEMA)
+def sign_in(auth_user):
+    user = users.get(auth_user['username'])
+    if user is not None and auth_user['password'] == user['password']:
+        return [{'sign_in': True}]
+    else:
+        return [{'sign_in': False}]
+
+
+@operation('delete_user_id', int)
+def delete_user(user_id):
+    user = users.get_by('id', user_id)
+    if user is not None:
+        users.remove(user)
+        storage.delete('users', user['username'])
+        log.info('User deleted', extra=fields(user_id=user_id))
+        return users.values()
+    return [{'delete_user_id': 'user id not found'}]
+
+
+# Books CRUD Operations
+
+@operation('store_book', BOOK_SCHEMA)
+def store_book(new_book):
+    if not books.add(new_book):
+        return [{'store_book': 'book name already exists'}]
+    storage.put('books', new_book['title'], new_book)
+    log.info('Book stored', extra=fields(book_id=new_book.get('id')))
+    return books.values()
+
+
+# Add many books in one request, e.g. from bulk_load.py
+@operation('bulk_store_books', [BOOK_SCHEMA])
+def bulk_store_books(new_books):
+    stored = duplicates = 0
+    for new_book in new_books:
+        if books.add(new_book):
+            storage.put('books', new_book['title'], new_book)
+            stored += 1
         else:
-            books.append(new_book)
-            return books
-
-    # Borrow book
-    elif operation == {'borrow_book': True}:
-        print('BORROW BOOK')
-        book_id = book
-        for book in books:
-            if book['id'] == book_id:
-                book['available'] = False
-                return books
-        return [{'borrow_book': 'book id not found'}]
-
-    # Delete book
-    elif operation == {'delete_book_id': True}:
-        print('DELETE BOOK ID')
-        book_id = book
-        for book in books:
-            if book['id'] == book_id:
-                books.remove(book)
-                return books
-        return [{'delete_book_id': 'book id not found'}]
-
-    elif operation == {'delete_all_books': True}:
-        print('DELETE ALL BOOKS')
-        books.clear()
-        return books
-
-    elif operation == {'return_book': True}:
-        book_id = book
-        for book in books:
-            if book['id'] == book_id:
-                book['available'] = True
-                return books
-        return [{'borrow_book': 'book id not found'}]
-
-
-lms_microservice()
+            duplicates += 1
+    log.info('Books bulk stored', extra=fields(stored=stored, duplicates=duplicates))
+    # Only the counts are returned; echoing the catalog would dwarf the chunk itself
+    return [{'bulk_store_books': {'stored': stored, 'duplicates': duplicates}}]
+
+
+@operation('borrow_book', int)
+def borrow_book(book_id):
+    book = books.get_by('id', book_id)
+    if book is not None:
+        book['available'] = False
+        storage.put('books', book['title'], book)
+        return books.values()
+    return [{'borrow_book': 'book id not found'}]
+
+
+@operation('delete_book_id', int)
+def delete_book(book_id):
+    book = books.get_by('id', book_id)
+    if book is not None:
+        books.remove(book)
+        storage.delete('books', book['title'])
+        log.info('Book deleted', extra=fields(book_id=book_id))
+        return books.values()
+    return [{'delete_book_id': 'book id not found'}]
+
+
+@operation('delete_all_books')
+def delete_all_books(_):
+    books.clear()
+    storage.clear('books')
+    log.warning('All books deleted')
+    return books.values()
+
+
+@operation('return_book', int)
+def return_book(book_id):
+    book = books.get_by('id', book_id)
+    if book is not None:
+        book['available'] = True
+        storage.put('books', book['title'], book)
+        return books.values()
+    return [{'borrow_book': 'book id not found'}]
+
+
+# Message storing
+
+@operation('store_message', dict)
+def store_message(new_message):
+    record, dropped = messages.append(new_message)
+    storage.put('messages', record['message_id'], record)
+    forget_messages(dropped)
+    # Only an acknowledgement; read messages back with get_messages
+    return [{'store_message': {'message_id': record['message_id']}}]
+
+
+@operation('get_messages', {'since_id?': int, 'limit?': int}, default={})
+def get_messages(query):
+    """
+    Page through stored messages, oldest first.
+    Payload is {'since_id': ..., 'limit': ...}: messages with a greater id than
+    since_id (all kept messages if omitted), at most limit of them.
+    'missed' is True if messages after since_id were already dropped.
+    """
+    since_id = query.get('since_id')
+    limit = min(max(query.get('limit', DEFAULT_MESSAGE_LIMIT), 0), MAX_MESSAGE_LIMIT)
+    forget_messages(messages.trim())
+    page = messages.since(since_id, limit)
+    next_since_id = page[-1]['message_id'] if page else since_id
+    return [{'get_messages': {
+        'messages': page,
+        'next_since_id': next_since_id,
+        'more': bool(page) and page[-1]['message_id'] + 1 < messages.next_id(),
+        'missed': since_id is not None and since_id + 1 < messages.oldest_id(),
+    }}]
+
+
+if __name__ == "__main__":
+    lms_microservice()
@@ -140,3 +140,9 @@ if __name__ == "__main__":
     print('CREATE MESSAGE')
     operation11 = [{'key1': 'valueA', 'key2': 'valueB', 'id': 100}]
     get_micro_response(operation11)
+
+    input()
+    time.sleep(delay)
+    print('GET MESSAGES')
+    operation12 = [{'get_messages': True}, {'since_id': -1, 'limit': 10}]
+    get_micro_response(operation12)
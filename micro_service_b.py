@@ -1,52 +1,185 @@
 # Microservice B: Book Returns and Overdue Alerts
-import zmq
-import json
+import bisect
+import heapq
+import itertools
+import threading
+from collections import deque
 from datetime import datetime, timedelta
+from service_logging import configure_logging, fields, get_logger
+from events import BORROW_TOPIC, EVENT_PORTS, OVERDUE_TOPIC, EventPublisher, NullPublisher
+from storage import MemoryStorage, open_storage
+from zmq_server import BOOT_ID, make_version, serve
 
-# In-memory storage for borrowed books
-borrowed_books = []
+log = get_logger("micro_service_b")
 
-def borrowed_books_service():
+# In-memory storage for borrowed books, keyed by (user_id, book_id)
+borrowed_books = {}
+# Secondary indexes kept in step with borrowed_books
+borrowed_by_user = {}  # user_id -> {book_id: record}
+due_by_user = {}  # user_id -> [(due_date, seq, book_id)] sorted by due date
+due_entries = {}  # (user_id, book_id) -> its entry in due_by_user
+due_seq = itertools.count()  # Tie-breaker so entries never compare book ids
+# Every loan by due date, for the overdue scanner: (due_date, seq, user_id, book_id).
+# Returned loans are left in place and skipped when popped.
+due_heap = []
+overdue_books = {}  # (user_id, book_id) -> record, for loans the scanner found overdue, by due date
+overdue_version = 0  # Number of changes to overdue_books
+storage = MemoryStorage()  # Replaced by the configured backend in load_state()
+user_versions = {}  # user_id -> number of changes to that user's borrow records
+publisher = NullPublisher()  # Replaced by a PUB socket when the service starts
+
+# Recent borrows and returns, for subscribers catching up on missed events
+CHANGE_LOG_SIZE = 10000
+CHANGE_PAGE_SIZE = 500
+change_log = deque(maxlen=CHANGE_LOG_SIZE)
+change_seq = 0  # Sequence number of the latest change
+
+# Overdue scanner: loans examined per hold of state_lock, loans per published
+# overdue event, and the longest sleep between scans (guards against clock changes)
+SCAN_CHUNK = 1000
+OVERDUE_EVENT_BATCH = 1000
+MAX_SCAN_SLEEP = 3600
+scan_wakeup = threading.Event()  # Set when a loan due before the next planned scan is added
+
+# Held around each request so worker threads never see half-applied updates
+state_lock = threading.Lock()
+
+def borrowed_books_service(workers=None):
     """
     Microservice B: Manages borrowed books.
     Operations:
         - get_borrowed_books: Fetch the list of books borrowed by a specific user.
         - borrow_book: Add a book to the borrowed list with a due date.
         - return_book: Remove a book from the borrowed list.
+        - cancel_borrow: Remove a loan created by a borrow that was rolled back.
+        - get_changes: Borrows and returns after a change log cursor.
+        - get_overdue_books: Every overdue loan found by the overdue scanner.
     """
-    context = zmq.Context()
-    socket = context.socket(zmq.REP)
-    socket.bind("tcp://*:5556")  # Bind to port 5556 for Microservice B
+    global publisher
+    configure_logging("micro_service_b")
+    load_state()
+    publisher = EventPublisher(EVENT_PORTS[5556])
+    threading.Thread(target=overdue_scanner, daemon=True).start()
+    log.info("Microservice B (Borrowed Books Management) is running...", extra=fields(loans=len(borrowed_books)))
+    try:
+        serve(5556, handle_request, workers, state_lock, request_version, OPERATIONS)  # Bind to port 5556 for Microservice B
+    finally:
+        publisher.close()
+        storage.close()
 
-    print("Microservice B (Borrowed Books Management) is running...")
+def load_state():
+    """Open the configured storage backend and reload the borrowed books from it."""
+    global storage
+    storage = open_storage("micro_service_b")
+    for record in storage.load().get("borrowed_books", []):
+        borrowed_books[(record["user_id"], record["book_id"])] = record
+        index_borrow(record)
 
-    while True:
-        # Receive the request
-        message = socket.recv()
-        data = json.loads(message.decode())
-        operation = data[0]  # Operation type
-        payload = data[1]    # Data sent with the request
+# Operations handle_request answers, named in the request metrics
+OPERATIONS = ("get_borrowed_books", "get_history_borrowed_books", "borrow_book", "return_book",
+              "cancel_borrow", "check_overdue_books", "get_changes", "get_overdue_books")
+
+
+def handle_request(data):
+    """
+    Dispatch a single request to its handler.
+    :param data: The decoded [operation, payload] request.
+    :return: The response to send back.
+    """
+    operation = data[0]  # Operation type
+    payload = data[1]    # Data sent with the request
+
+    # Handle operations
+    if operation == "get_borrowed_books":
+        response = handle_get_borrowed_books(payload)
+
+    elif operation == "get_history_borrowed_books":
+        response = handle_get_history_borrowed_books(payload)
 
-        # Handle operations
-        if operation == "get_borrowed_books":
-            response = handle_get_borrowed_books(payload)
+    elif operation == "borrow_book":
+        response = handle_borrow_book(payload)
 
-        if operation =="get_history_borrowed_books":
-            response = handle_get_history_borrowed_books(payload)
-        
-        elif operation == "borrow_book":
-            response = handle_borrow_book(payload)
+    elif operation == "return_book":
+        response = handle_return_book(payload)
 
-        elif operation == "return_book":
-            response = handle_return_book(payload)
+    elif operation == "cancel_borrow":
+        response = handle_cancel_borrow(payload)
 
-        elif operation == "check_overdue_books":
-            response = handle_check_overdue_books(payload)
-        else:
-            response = {"status": "error", "message": "Invalid operation"}
+    elif operation == "check_overdue_books":
+        response = handle_check_overdue_books(payload)
 
-        # Send the response
-        socket.send(json.dumps(response).encode())
+    elif operation == "get_changes":
+        response = handle_get_changes(payload)
+
+    elif operation == "get_overdue_books":
+        response = handle_get_overdue_books(payload)
+    else:
+        response = {"status": "error", "message": "Invalid operation"}
+
+    return response
+
+def request_version(data):
+    """
+    Version of the data a read request depends on, for conditional fetches.
+    :param data: The decoded [operation, payload] request.
+    :return: A version tag, or None if the request cannot be served conditionally.
+    """
+    operation, user_id = data
+    if operation == "get_overdue_books":
+        return make_version("overdue", overdue_version)
+    if operation in ("get_borrowed_books", "get_history_borrowed_books"):
+        return make_version(user_versions.get(user_id, 0))
+    if operation == "check_overdue_books":
+        # Overdue status also changes when the date does
+        return make_version(user_versions.get(user_id, 0), datetime.now().strftime("%Y-%m-%d"))
+    return None
+
+def publish_change(change, record):
+    """
+    Log a borrow or return and announce it so subscribers can update their copies.
+    Each change carries the next sequence number, so a subscriber that sees a
+    gap knows to catch up with get_changes.
+    """
+    global change_seq
+    change_seq += 1
+    user_id = record["user_id"]
+    event = {"type": change, "boot": BOOT_ID, "seq": change_seq, "user_id": user_id,
+             "book_id": record["book_id"], "due_date": record["due_date"],
+             "version": make_version(user_versions.get(user_id, 0)), "record": dict(record)}
+    change_log.append(event)
+    publisher.publish(BORROW_TOPIC, event)
+
+def index_borrow(record):
+    """
+    Add a borrow record to the per-user indexes.
+    Due dates are ISO strings, so they sort chronologically without parsing.
+    """
+    user_id, book_id = record["user_id"], record["book_id"]
+    user_versions[user_id] = user_versions.get(user_id, 0) + 1
+    borrowed_by_user.setdefault(user_id, {})[book_id] = record
+    entry = (record["due_date"], next(due_seq), book_id)
+    bisect.insort(due_by_user.setdefault(user_id, []), entry)
+    due_entries[(user_id, book_id)] = entry
+    heap_entry = (entry[0], entry[1], user_id, book_id)
+    heapq.heappush(due_heap, heap_entry)
+    if due_heap[0] is heap_entry:
+        scan_wakeup.set()  # Due before the loan the scanner is sleeping until
+
+def unindex_borrow(record):
+    """Remove a borrow record from the per-user indexes."""
+    global overdue_version
+    user_id, book_id = record["user_id"], record["book_id"]
+    user_versions[user_id] += 1
+    if overdue_books.pop((user_id, book_id), None) is not None:
+        overdue_version += 1
+    user_books = borrowed_by_user[user_id]
+    del user_books[book_id]
+    entry = due_entries.pop((user_id, book_id))
+    user_due = due_by_user[user_id]
+    del user_due[bisect.bisect_left(user_due, entry)]
+    if not user_books:
+        del borrowed_by_user[user_id]
+        del due_by_user[user_id]
 
 def handle_get_history_borrowed_books(user_id):
     """
@@ -54,7 +187,7 @@ def handle_get_history_borrowed_books(user_id):
     :param user_id: The ID of the user.
     :return: A response containing the list of borrowed books.
     """
-    user_books = [book for book in borrowed_books if book["user_id"] == user_id]
+    user_books = list(borrowed_by_user.get(user_id, {}).values())
     return {"status": "success", "borrowed_books": user_books}
 
 
@@ -64,21 +197,20 @@ def handle_get_borrowed_books(user_id):
     :param user_id: The ID of the user.
     :return: A response containing the list of borrowed books.
     """
-    user_books = [book for book in borrowed_books if book["user_id"] == user_id and book['status'] == "borrowed"]
-    for book in borrowed_books:
-        print(book)
+    user_books = [book for book in borrowed_by_user.get(user_id, {}).values() if book['status'] == "borrowed"]
     return {"status": "success", "borrowed_books": user_books}
     
 
 def handle_borrow_book(book_data):
     """
     Add a book to the borrowed books list with a due date.
-    :param book_data: A dictionary containing user_id, book_id, title, borrowed_date, and due_date.
+    :param book_data: A dictionary containing user_id, book_id, title, borrowed_date, and due_date,
+                      and optionally the loan_id a coordinator can later cancel the loan by.
     :return: A response indicating success or failure.
     """
-    for book in borrowed_books:
-        if book["user_id"] == book_data["user_id"] and book["book_id"] == book_data["book_id"]:
-            return {"status": "error", "message": "Book already borrowed"}
+    key = (book_data["user_id"], book_data["book_id"])
+    if key in borrowed_books:
+        return {"status": "error", "message": "Book already borrowed"}
 
     # Calculate due date (e.g., 7 days from borrowed_date)
     borrowed_date = datetime.now()
@@ -87,10 +219,11 @@ def handle_borrow_book(book_data):
     book_data["borrowed_date"] = borrowed_date.strftime("%Y-%m-%d")
     book_data["due_date"] = due_date.strftime("%Y-%m-%d")
     book_data["status"] = "borrowed" 
-    borrowed_books.append(book_data)
-    print("Current borrowed_books list after borrow operation:")
-    for book in borrowed_books:
-        print(book)
+    borrowed_books[key] = book_data
+    index_borrow(book_data)
+    storage.put("borrowed_books", key, book_data)
+    publish_change("borrow", book_data)
+    log.debug("Book borrowed", extra=fields(user_id=key[0], book_id=key[1], loans=len(borrowed_books)))
     return {"status": "success", "message": "Book borrowed successfully", "due_date": book_data["due_date"]}
 
 def handle_return_book(return_data):
@@ -99,33 +232,143 @@ def handle_return_book(return_data):
     :param return_data: A dictionary containing user_id and book_id.
     :return: A response indicating success or failure.
     """
-    for book in borrowed_books:
-        if book["user_id"] == return_data["user_id"] and book["book_id"] == return_data["book_id"]:
-            book["status"] = "returned"
-            borrowed_books.remove(book)
-            return {"status": "success", "message": "Book returned successfully"}
+    book = borrowed_books.pop((return_data["user_id"], return_data["book_id"]), None)
+    if book is not None:
+        unindex_borrow(book)
+        storage.delete("borrowed_books", (book["user_id"], book["book_id"]))
+        book["status"] = "returned"
+        book["returned_date"] = datetime.now().strftime("%Y-%m-%d")
+        publish_change("return", book)
+        return {"status": "success", "message": "Book returned successfully"}
 
     return {"status": "error", "message": "Book not found in borrowed list"}
 
+def handle_cancel_borrow(cancel_data):
+    """
+    Remove a loan whose borrow was rolled back, e.g. because Microservice E never
+    got this service's reply. Only the loan created with the given loan_id is
+    removed, so a loan the user already held is left alone. Subscribers are told
+    the loan was cancelled rather than returned.
+    :param cancel_data: A dictionary containing user_id, book_id and loan_id.
+    :return: A response telling whether a loan was cancelled.
+    """
+    key = (cancel_data["user_id"], cancel_data["book_id"])
+    book = borrowed_books.get(key)
+    if book is None or cancel_data.get("loan_id") is None or book.get("loan_id") != cancel_data["loan_id"]:
+        return {"status": "success", "cancelled": False}
+    del borrowed_books[key]
+    unindex_borrow(book)
+    storage.delete("borrowed_books", key)
+    book["status"] = "cancelled"
+    publish_change("cancel", book)
+    return {"status": "success", "cancelled": True}
+
 def handle_check_overdue_books(user_id):
     """
     Check if the user has any overdue books.
     :param user_id: The ID of the user.
     :return: A response containing overdue books or a message if no overdue books are found.
     """
-    overdue_books = []
-    today = datetime.now().date()
+    today = datetime.now().strftime("%Y-%m-%d")
+    user_due = due_by_user.get(user_id, [])
+    user_books = borrowed_by_user.get(user_id, {})
 
-    for book in borrowed_books:
-        if book["user_id"] == user_id:
-            due_date = datetime.strptime(book["due_date"], "%Y-%m-%d").date()
-            if today > due_date:
-                overdue_books.append(book)
+    # Entries due strictly before today form a prefix of the sorted list
+    end = bisect.bisect_left(user_due, (today,))
+    overdue_books = [user_books[book_id] for _, _, book_id in user_due[:end]]
 
     if overdue_books:
         return {"status": "alert", "message": "You have overdue books!", "overdue_books": overdue_books}
     else:
         return {"status": "success", "message": "No overdue books."}
 
+def handle_get_changes(cursor):
+    """
+    Fetch the borrows and returns after a subscriber's change log cursor.
+    :param cursor: A dictionary containing boot (the BOOT_ID the cursor is from), after
+                   (the last sequence number seen) and optionally limit.
+    :return: A response with the changes in order and the latest sequence number. If
+             the log no longer reaches back to the cursor (e.g. after a restart),
+             reset is True and borrowed_books holds every current record instead.
+    """
+    after = cursor.get("after", 0)
+    limit = cursor.get("limit") or CHANGE_PAGE_SIZE
+    oldest = change_log[0]["seq"] if change_log else change_seq + 1
+    # A new subscriber (no boot yet) can replay the log while it still starts at the first change
+    replayable = cursor.get("boot") == BOOT_ID or (cursor.get("boot") is None and oldest == 1)
+    if not replayable or after < oldest - 1:
+        return {"status": "success", "reset": True, "boot": BOOT_ID, "seq": change_seq,
+                "borrowed_books": list(borrowed_books.values())}
+    start = after - oldest + 1
+    changes = list(itertools.islice(change_log, start, start + limit))
+    return {"status": "success", "reset": False, "boot": BOOT_ID, "seq": change_seq, "changes": changes}
+
+def handle_get_overdue_books(options=None):
+    """
+    Fetch every overdue loan, oldest due date first, for nightly reports.
+    :param options: None for every loan, or a dictionary with offset and limit for one page.
+    :return: A response containing the page of overdue loans, their total and the offset
+             of the next page (None on the last page).
+    """
+    options = options or {}
+    offset = options.get("offset", 0)
+    limit = options.get("limit")
+    total = len(overdue_books)
+    end = total if limit is None else min(offset + limit, total)
+    books = list(itertools.islice(overdue_books.values(), offset, end))
+    return {"status": "success", "overdue_books": books, "total": total,
+            "next_offset": end if end < total else None}
+
+def pop_overdue(today):
+    """
+    Move up to SCAN_CHUNK loans due before today from due_heap to overdue_books.
+    :return: The newly overdue records.
+    """
+    global overdue_version
+    found = []
+    while due_heap and due_heap[0][0] < today and len(found) < SCAN_CHUNK:
+        due_date, seq, user_id, book_id = heapq.heappop(due_heap)
+        if due_entries.get((user_id, book_id)) != (due_date, seq, book_id):
+            continue  # Returned since it was pushed
+        record = borrowed_books[(user_id, book_id)]
+        overdue_books[(user_id, book_id)] = record
+        found.append(dict(record))
+    if found:
+        overdue_version += 1
+    return found
+
+def seconds_until_next_due():
+    """Seconds until the earliest loan becomes overdue, i.e. the midnight after its due date."""
+    if not due_heap:
+        return MAX_SCAN_SLEEP
+    overdue_at = datetime.strptime(due_heap[0][0], "%Y-%m-%d") + timedelta(days=1)
+    return min(max((overdue_at - datetime.now()).total_seconds(), 0), MAX_SCAN_SLEEP)
+
+def overdue_scanner():
+    """
+    Background thread announcing loans as they become overdue.
+    Sleeps until the next due boundary, then drains the heap in chunks so
+    thousands of loans expiring at midnight never hold up requests for long,
+    and publishes the newly overdue loans in bulk on the overdue topic.
+    """
+    while True:
+        today = datetime.now().strftime("%Y-%m-%d")
+        found = []
+        while True:
+            with state_lock:
+                chunk = pop_overdue(today)
+            found.extend(chunk)
+            if len(chunk) < SCAN_CHUNK:
+                break
+        if found:
+            log.info("Loans became overdue", extra=fields(count=len(found), date=today))
+        for start in range(0, len(found), OVERDUE_EVENT_BATCH):
+            publisher.publish(OVERDUE_TOPIC, {"type": "overdue", "date": today,
+                                              "books": found[start:start + OVERDUE_EVENT_BATCH]})
+        with state_lock:
+            scan_wakeup.clear()
+            delay = seconds_until_next_due()
+        scan_wakeup.wait(delay)
+
 if __name__ == "__main__":
     borrowed_books_service()
@@ -1,66 +1,248 @@
-import zmq
-import json
+import os
+import threading
+from service_logging import configure_logging, fields, get_logger
+from events import BORROW_TOPIC, EVENT_PORTS, HISTORY_TOPIC, EventPublisher, EventSubscriber, NullPublisher
+from storage import MemoryStorage, open_storage
+from zmq_client import CircuitBreaker, ServiceError, communicate_with_microservice
+from zmq_server import make_version, serve
 
-# In-memory database for borrowing history
-borrowing_history = []
+log = get_logger("micro_service_c")
 
-def communicate_with_microservice(port, operation, data=None):
-    """Helper function to communicate with other microservices."""
-    context = zmq.Context()
-    socket = context.socket(zmq.REQ)
-    socket.connect(f"tcp://localhost:{port}")
-    request = [operation, data]
-    socket.send(json.dumps(request).encode())
-    response = socket.recv()
-    return json.loads(response.decode())
+# Materialized borrowing history, one entry per (user_id, book_id, borrowed_date)
+history = {}
+history_by_user = {}  # user_id -> [history key], in the order the books were borrowed
+user_versions = {}  # user_id -> number of changes to that user's history
+# Position in Microservice B's change log up to which the history is complete
+sync_cursor = {"boot": None, "after": 0}
+storage = MemoryStorage()  # Replaced by the configured backend in load_state()
+publisher = NullPublisher()  # Replaced by a PUB socket when the service starts
 
-def borrowing_history_service():
-    context = zmq.Context()
-    socket = context.socket(zmq.REP)
-    socket.bind("tcp://*:5558")  # Bind to port 5558 for borrowing history microservice
+# Held around each request and while applying changes from Microservice B
+history_lock = threading.Lock()
+# Set when a missed event is noticed, so the sync thread catches up right away
+sync_requested = threading.Event()
 
-    print("Microservice C (Borrowing History Service) is running...")
+# Catch up with Microservice B at least this often, in case the last event was lost
+SYNC_INTERVAL = 30
+# Changes requested from Microservice B per sync round trip
+SYNC_PAGE_SIZE = 500
+# Seconds to wait for each reply from Microservice B, and how often to retry a timed-out sync request
+SYNC_TIMEOUT = float(os.environ.get("SYNC_TIMEOUT", "2"))
+SYNC_RETRIES = int(os.environ.get("SYNC_RETRIES", "2"))
+# Stops syncing from queueing up behind an unhealthy Microservice B; history is
+# still served from the local copy (flagged stale) while it is open
+b_breaker = CircuitBreaker(failure_threshold=3, reset_timeout=10)
 
+def borrowing_history_service(workers=None):
+    """
+    Microservice C: Keeps every user's borrowing history.
+    Borrows and returns arrive as events from Microservice B, with a periodic
+    sync over B's change log to recover any that were missed, so history
+    queries are answered without calling B.
+    """
+    global publisher
+    configure_logging("micro_service_c")
+    load_state()
+    publisher = EventPublisher(EVENT_PORTS[5558])
+    subscriber = EventSubscriber(EVENT_PORTS[5556], [BORROW_TOPIC], on_borrow_event)
+    threading.Thread(target=sync_loop, daemon=True).start()
+    log.info("Microservice C (Borrowing History Service) is running...", extra=fields(entries=len(history)))
+    try:
+        serve(5558, handle_request, workers, history_lock, request_version, OPERATIONS)  # Bind to port 5558 for borrowing history microservice
+    finally:
+        subscriber.stop()
+        publisher.close()
+        storage.close()
+
+def load_state():
+    """Open the configured storage backend and reload the borrowing history and sync cursor from it."""
+    global storage
+    storage = open_storage("micro_service_c")
+    state = storage.load()
+    for record in state.get("borrowing_history", []):
+        key = history_key(record)
+        if key not in history:
+            history_by_user.setdefault(record["user_id"], []).append(key)
+        history[key] = record
+    for cursor in state.get("sync", []):
+        sync_cursor.update(cursor)
+
+def history_key(record):
+    return record["user_id"], record["book_id"], record["borrowed_date"]
+
+def apply_record(record):
+    """
+    Insert or update the history entry for one borrow record.
+    :return: True if the history changed.
+    """
+    key = history_key(record)
+    entry = history.get(key)
+    if entry is None:
+        entry = history[key] = dict(record)
+        history_by_user.setdefault(record["user_id"], []).append(key)
+    elif entry == record:
+        return False
+    else:
+        entry.update(record)
+    user_versions[record["user_id"]] = user_versions.get(record["user_id"], 0) + 1
+    storage.put("borrowing_history", key, entry)
+    return True
+
+def remove_record(record):
+    """
+    Drop the history entry of a borrow that was cancelled, since it never took effect.
+    :return: True if the history changed.
+    """
+    key = history_key(record)
+    if history.pop(key, None) is None:
+        return False
+    history_by_user[record["user_id"]].remove(key)
+    user_versions[record["user_id"]] = user_versions.get(record["user_id"], 0) + 1
+    storage.delete("borrowing_history", key)
+    return True
+
+def save_cursor(boot, after):
+    sync_cursor["boot"] = boot
+    sync_cursor["after"] = after
+    storage.put("sync", "cursor", dict(sync_cursor))
+
+def publish_changes(user_ids):
+    """Tell subscribers whose history changed."""
+    for user_id in user_ids:
+        publisher.publish(HISTORY_TOPIC, {"type": "history", "user_id": user_id,
+                                          "version": make_version(user_versions[user_id])})
+
+def apply_change(change):
+    """
+    Apply one change from Microservice B if it is the next one after the cursor.
+    Changes already applied are ignored, so events and syncs may overlap.
+    :return: False if earlier changes were missed and a sync is needed.
+    """
+    # A cursor that has never synced accepts B's very first change
+    fresh = sync_cursor["boot"] is None and change["seq"] == 1
+    if (change["boot"] != sync_cursor["boot"] and not fresh) or change["seq"] > sync_cursor["after"] + 1:
+        return False
+    if change["seq"] == sync_cursor["after"] + 1:
+        apply = remove_record if change["type"] == "cancel" else apply_record
+        if apply(change["record"]):
+            publish_changes([change["user_id"]])
+        save_cursor(change["boot"], change["seq"])
+    return True
+
+def apply_snapshot(reply):
+    """
+    Rebuild the cursor from every current borrow record, for when B's change log
+    no longer reaches back to the cursor (e.g. B restarted). Entries still marked
+    borrowed that B no longer has were returned while the changes were missed.
+    """
+    changed = set()
+    current = set()
+    log.info("Resyncing from a snapshot of Microservice B", extra=fields(loans=len(reply["borrowed_books"])))
+    for record in reply["borrowed_books"]:
+        current.add(history_key(record))
+        if apply_record(record):
+            changed.add(record["user_id"])
+    for key, entry in list(history.items()):
+        if entry["status"] == "borrowed" and key not in current:
+            apply_record(dict(entry, status="returned", returned_date=None))
+            changed.add(entry["user_id"])
+    save_cursor(reply["boot"], reply["seq"])
+    publish_changes(changed)
+
+def sync_with_b():
+    """Fetch Microservice B's changes since the cursor, page by page, until caught up."""
     while True:
-        message = socket.recv()
-        data = json.loads(message.decode())
-        operation = data[0]  # Operation type
-        payload = data[1]    # Data sent with the request
+        with history_lock:
+            cursor = dict(sync_cursor, limit=SYNC_PAGE_SIZE)
+        # Not holding the lock, so requests keep being answered while B is slow
+        reply = communicate_with_microservice(5556, "get_changes", cursor, SYNC_TIMEOUT, SYNC_RETRIES, b_breaker)
+        if reply.get("status") != "success":
+            raise ServiceError(reply.get("message", "Failed to fetch changes from Microservice B"))
+        with history_lock:
+            if reply["reset"]:
+                apply_snapshot(reply)
+                return
+            for change in reply["changes"]:
+                apply_change(change)
+        if len(reply["changes"]) < SYNC_PAGE_SIZE:
+            return
 
-        if operation == "get_borrowing_history":
-            # Fetch borrowing history for the user
-            user_id = payload
-            response_b = communicate_with_microservice(5556, "get_history_borrowed_books", user_id)  # Fetch books from Microservice B
+def sync_loop():
+    """Sync with Microservice B on start, then periodically and whenever an event was missed."""
+    while True:
+        try:
+            sync_with_b()
+        except ServiceError as e:
+            log.warning("Sync with Microservice B failed", extra=fields(error=str(e)))
+        sync_requested.wait(SYNC_INTERVAL)
+        sync_requested.clear()
 
-            if response_b.get("status") == "success":
-                # Modify the borrowed books' status to 'returned' if already returned
-                for book in response_b["borrowed_books"]:
-                    if book["status"] == "returned":
-                        # Add book to borrowing history with a status
-                        borrowing_history.append(book)
+def on_borrow_event(topic, event):
+    """Apply a borrow, return or cancelled borrow announced by Microservice B."""
+    with history_lock:
+        if not apply_change(event):
+            sync_requested.set()
 
-                response = {"status": "success", "borrowed_books": response_b["borrowed_books"]}
+def request_version(data):
+    """
+    Version of the data a read request depends on, for conditional fetches.
+    :param data: The decoded [operation, payload] request.
+    :return: A version tag, or None if the request cannot be served conditionally.
+    """
+    operation, payload = data
+    if operation in ("get_borrowing_history", "get_borrowing_books"):
+        user_id = payload["user_id"] if isinstance(payload, dict) else payload
+        if b_breaker.is_open:
+            return make_version(user_versions.get(user_id, 0), "stale")
+        return make_version(user_versions.get(user_id, 0))
+    return None
 
-            else:
-                response = {"status": "error", "message": "Failed to fetch borrowing history from Microservice B"}
-        elif operation == "get_borrowing_books":
-            # Fetch borrowing history for the user
-            user_id = payload
-            response_b = communicate_with_microservice(5556, "get_borrowed_books", user_id)  # Fetch books from Microservice B
+def get_history_page(user_id, offset=0, limit=None, status=None):
+    """
+    One page of a user's history, oldest borrow first.
+    :param status: Only include entries with this status ("borrowed" or "returned").
+    :return: A response with the page, the total number of matching entries, the
+             offset of the next page (None on the last page) and whether the history
+             may be stale because Microservice B cannot be reached.
+    """
+    keys = history_by_user.get(user_id, [])
+    if status is None:
+        total = len(keys)
+        end = total if limit is None else offset + limit
+        entries = [history[key] for key in keys[offset:end]]
+    else:
+        matching = [history[key] for key in keys if history[key]["status"] == status]
+        total = len(matching)
+        end = total if limit is None else offset + limit
+        entries = matching[offset:end]
+    next_offset = end if end < total else None
+    return {"status": "success", "borrowed_books": entries, "total": total, "next_offset": next_offset,
+            "stale": b_breaker.is_open}
 
-            if response_b.get("status") == "success":
-              
-                borrowing_history.append(book)
+# Operations handle_request answers, named in the request metrics
+OPERATIONS = ("get_borrowing_history", "get_borrowing_books")
 
-                response = {"status": "success", "borrowed_books": response_b["borrowed_books"]}
 
-            else:
-                response = {"status": "error", "message": "Failed to fetch borrowing history from Microservice B"}
+def handle_request(data):
+    operation = data[0]  # Operation type
+    payload = data[1]    # Data sent with the request
 
+    if operation == "get_borrowing_history":
+        # Borrowing history for the user; the payload is the user id, or
+        # {"user_id": ..., "offset": ..., "limit": ..., "status": ...} for one page
+        if isinstance(payload, dict):
+            response = get_history_page(payload["user_id"], payload.get("offset", 0),
+                                        payload.get("limit"), payload.get("status"))
         else:
-            response = {"status": "error", "message": "Invalid operation"}
+            response = get_history_page(payload)
+    elif operation == "get_borrowing_books":
+        # Books the user currently has borrowed
+        response = get_history_page(payload, status="borrowed")
+
+    else:
+        response = {"status": "error", "message": "Invalid operation"}
 
-        socket.send(json.dumps(response).encode())
+    return response
 
 if __name__ == "__main__":
     borrowing_history_service()
@@ -1,6 +1,15 @@
 # Microservice D: Book Search and Reservation
-import zmq
-import json
+import bisect
+import threading
+import time
+from collections import deque
+from service_logging import configure_logging, fields, get_logger
+from events import BOOK_TOPIC, EVENT_PORTS, EventPublisher, NullPublisher
+from search_index import SearchIndex
+from storage import MemoryStorage, open_storage
+from zmq_server import make_version, serve
+
+log = get_logger("micro_service_d")
 
 #  in-memory book database
 books = [
@@ -15,72 +24,482 @@ books = [
     {"id": 9, "title": "Treasure Island", "author": "R.L. Stevenson", "available": True, "reserved": False},  # Reserved by someone
     {"id": 10, "title": "1984", "author": "George Orwell", "available": False, "reserved": True},  # Reserved by someone
 ]
+books_by_id = {book["id"]: book for book in books}
+book_ids = sorted(books_by_id)  # Keyset order for paginated get_books
+search_index = SearchIndex(books)
+storage = MemoryStorage()  # Replaced by the configured backend in load_state()
+catalog_version = 0  # Incremented on every change to the catalog
+publisher = NullPublisher()  # Replaced by a PUB socket when the service starts
 
+# Books received by bulk_load_books but not yet merged into the catalog
+staged_books = {}  # book id -> book
 
-def book_service():
-    context = zmq.Context()
-    socket = context.socket(zmq.REP)
-    socket.bind("tcp://*:5557")  # Bind to port 5557 for book microservice
+# Reservations: users queue for a borrowed book and, when it is returned, the
+# first of them gets a hold on it that lapses after HOLD_SECONDS
+reservation_queues = {}  # book id -> deque of waiting user ids, first come first served
+holds = {}  # book id -> {"user_id": ..., "expires": epoch seconds}
+reservations_by_user = {}  # user id -> ids of the books the user is queued for or holds
+HOLD_SECONDS = 48 * 3600
+HOLD_SWEEP_INTERVAL = 60  # Seconds between checks for lapsed holds
 
-    print("Microservice D (Book Service) is running...")
+# Borrows made with a loan id, so a coordinator can cancel the one it made
+loans = {}  # book id -> {"book_id": ..., "loan_id": ..., "hold": hold the borrow collected or None}
+
+
+# Held around each request so worker threads never see half-applied updates
+state_lock = threading.Lock()
+
+
+def book_service(workers=None):
+    global publisher
+    configure_logging("micro_service_d")
+    load_state()
+    publisher = EventPublisher(EVENT_PORTS[5557])
+    threading.Thread(target=hold_sweeper, daemon=True).start()
+    log.info("Microservice D (Book Service) is running...", extra=fields(books=len(books)))
+    try:
+        serve(5557, handle_request, workers, state_lock, request_version, OPERATIONS)  # Bind to port 5557 for book microservice
+    finally:
+        publisher.close()
+        storage.close()
+
+
+def load_state():
+    """
+    Open the configured storage backend and reload the catalog from it.
+    On first start the built-in catalog is written to storage instead.
+    """
+    global storage
+    storage = open_storage("micro_service_d")
+    state = storage.load()
+    stored_books = state.get("books")
+    if stored_books:
+        books[:] = stored_books
+        rebuild_indexes()
+    else:
+        for book in books:
+            storage.put("books", book["id"], book)
+    for reservation in state.get("reservations", []):
+        book_id = reservation["book_id"]
+        reservation_queues[book_id] = deque(reservation["queue"])
+        if reservation["hold"]:
+            holds[book_id] = reservation["hold"]
+        for user_id in reservation["queue"] + ([reservation["hold"]["user_id"]] if reservation["hold"] else []):
+            reservations_by_user.setdefault(user_id, set()).add(book_id)
+    for loan in state.get("loans", []):
+        loans[loan["book_id"]] = loan
+
+
+def request_version(data):
+    """Version of the catalog for read requests, so clients can fetch conditionally."""
+    if data[0] in ("get_books", "search_books", "get_reservations"):
+        return make_version(catalog_version)
+    return None
 
-    while True:
-        message = socket.recv()
-        data = json.loads(message.decode())
-        operation = data[0]  # Operation type
-        payload = data[1]    # Data sent with the request
-
-        if operation == "get_books":
-            # Return the list of books
-            response = {"books": books}
-
-        elif operation == "search_books":
-            # Search for books by title or author
-            query = payload.lower()
-            results = [book for book in books if query in book["title"].lower() or query in book["author"].lower()]
-            response = {"books": results}
-
-        elif operation == "borrow_book":
-            # Borrow a book
-            book_id = payload
-            book = next((b for b in books if b["id"] == book_id), None)
-            if book and book["available"]:
-                book["available"] = False
-                response = {"status": "success", "message": "Book marked as borrowed"}
-            else:
-                response = {"status": "error", "message": "Book not available"}
-                
-
-        elif operation == "reserve_book":
-            # Reserve a book
-            book_id = payload
-            book = next((b for b in books if b["id"] == book_id), None)
-            if book:
-                if not book["available"] and not book["reserved"]:
-                    # Reserve the book
-                    book["reserved"] = True
-                    response = {"status": "success", "message": "Book reserved successfully"}
-                elif book["reserved"]:
-                    response = {"status": "error", "message": "Book is already reserved"}
-                else:
-                    response = {"status": "error", "message": "Book is available, no need to reserve"}
-            else:
-                response = {"status": "error", "message": "Book not found"}
-        elif operation == "return_book":
-            # Return a borrowed book
-            book_id = payload  # Payload is the book id
-            book = next((b for b in books if b["id"] == book_id), None)
-            if book:
-                book["available"] = True  # Mark the book as available
-                response = {"status": "success", "message": "Book returned successfully"}
-            else:
-                response = {"status": "error", "message": "Book not found"}
 
+def catalog_changed(book=None):
+    """
+    Bump the catalog version and announce the change.
+    :param book: The book whose availability or reservation changed, or None if many books changed.
+    """
+    global catalog_version
+    catalog_version += 1
+    if book is None:
+        event = {"type": "catalog", "version": make_version(catalog_version)}
+    else:
+        event = {"type": "book", "id": book["id"], "available": book["available"],
+                 "reserved": book["reserved"], "held_for": book.get("held_for"),
+                 "version": make_version(catalog_version)}
+    publisher.publish(BOOK_TOPIC, event)
 
 
+def rebuild_indexes():
+    """Rebuild every lookup structure from the books list."""
+    global book_ids
+    books_by_id.clear()
+    books_by_id.update((book["id"], book) for book in books)
+    book_ids = sorted(books_by_id)
+    search_index.clear()
+    search_index.add_many(books)
+
+
+# Operations handle_request answers, named in the request metrics
+OPERATIONS = ("get_books", "search_books", "borrow_book", "undo_borrow", "cancel_borrow", "reserve_book",
+              "cancel_reservation", "get_reservations", "return_book", "bulk_load_books")
+
+
+def handle_request(data):
+    operation = data[0]  # Operation type
+    payload = data[1]    # Data sent with the request
+
+    if operation == "get_books":
+        # Return the list of books, or one page of it when options are given
+        if payload:
+            response = get_books_page(payload)
         else:
-            response = {"status": "error", "message": "Invalid operation"}
+            response = {"books": books, "total": len(books)}
+
+    elif operation == "search_books":
+        # Search for books by title or author
+        # Payload is the query string, or {"query": ..., "limit": ..., "prefix": ...}
+        response = search_books(payload if isinstance(payload, dict) else {"query": payload})
+
+    elif operation == "borrow_book":
+        # Borrow a book; the payload is the book id, or {"book_id": ..., "user_id": ..., "loan_id": ...}
+        # so the user a returned copy is held for can collect it, and a coordinator can cancel the borrow
+        response = borrow_book(*reservation_request(payload),
+                               loan_id=payload.get("loan_id") if isinstance(payload, dict) else None)
+
+    elif operation == "undo_borrow":
+        # Compensate a borrow whose other half failed; payload is {"book_id": ..., "hold": ...}
+        # with the hold returned by borrow_book, if the borrow collected one
+        response = undo_borrow(payload.get("book_id"), payload.get("hold"))
+
+    elif operation == "cancel_borrow":
+        # Undo the borrow made with a loan id, e.g. one whose reply never reached the coordinator;
+        # payload is {"book_id": ..., "loan_id": ...}
+        response = cancel_borrow(payload.get("book_id"), payload.get("loan_id"))
+
+    elif operation == "reserve_book":
+        # Join the queue for a borrowed book; payload is {"book_id": ..., "user_id": ...}
+        response = reserve_book(*reservation_request(payload))
+
+    elif operation == "cancel_reservation":
+        # Leave a book's queue or give up its hold; payload is {"book_id": ..., "user_id": ...}
+        response = cancel_reservation(*reservation_request(payload))
+
+    elif operation == "get_reservations":
+        # The user's place in each queue they are in, and the holds waiting for them
+        response = get_reservations(payload)
+
+    elif operation == "return_book":
+        # Return a borrowed book, handing it to the next reserver if anyone is waiting
+        book_id = payload  # Payload is the book id
+        book = books_by_id.get(book_id)
+        if book:
+            forget_loan(book_id)
+            if book_id not in holds:
+                hand_off(book)
+            response = {"status": "success", "message": "Book returned successfully", "held_for": book.get("held_for")}
+        else:
+            response = {"status": "error", "message": "Book not found"}
+
+    elif operation == "bulk_load_books":
+        # Stage a chunk of books, merging them into the catalog on the final chunk
+        response = bulk_load_books(payload)
+
+    else:
+        response = {"status": "error", "message": "Invalid operation"}
+
+    return response
+
+
+
+def reservation_request(payload):
+    """Split a borrow/reservation payload into (book id, user id); a bare book id has no user."""
+    if isinstance(payload, dict):
+        return payload.get("book_id"), payload.get("user_id")
+    return payload, None
+
+
+def reservation_changed(book):
+    """Refresh a book's reservation fields, persist its queue and hold, and announce the change."""
+    book_id = book["id"]
+    queue = reservation_queues.get(book_id)
+    hold = holds.get(book_id)
+    book["reserved"] = bool(queue) or hold is not None
+    book["held_for"] = hold["user_id"] if hold else None
+    storage.put("books", book_id, book)
+    if queue or hold:
+        storage.put("reservations", book_id, {"book_id": book_id, "queue": list(queue or ()), "hold": hold})
+    else:
+        reservation_queues.pop(book_id, None)
+        storage.delete("reservations", book_id)
+    catalog_changed(book)
+
+
+def forget_reservation(user_id, book_id):
+    user_books = reservations_by_user.get(user_id)
+    if user_books is not None:
+        user_books.discard(book_id)
+        if not user_books:
+            del reservations_by_user[user_id]
+
+
+def hand_off(book):
+    """
+    Give a returned book to the first user in its queue as a hold, or make it
+    available if nobody is waiting. Runs under state_lock, so no other request
+    can take the copy in between.
+    """
+    book_id = book["id"]
+    holds.pop(book_id, None)
+    queue = reservation_queues.get(book_id)
+    if queue:
+        user_id = queue.popleft()
+        holds[book_id] = {"user_id": user_id, "expires": time.time() + HOLD_SECONDS}
+        book["available"] = False
+    else:
+        book["available"] = True
+    reservation_changed(book)
+
+
+def borrow_book(book_id, user_id, loan_id=None):
+    """
+    Mark a book as borrowed: any available book, or a held book by the user it is held for.
+    :param loan_id: Optional id cancel_borrow can later undo this borrow by.
+    :return: A response indicating success or failure.
+    """
+    book = books_by_id.get(book_id)
+    if book is None:
+        return {"status": "error", "message": "Book not available"}
+    hold = holds.get(book_id)
+    if hold is not None and hold["expires"] <= time.time():
+        expire_hold(book)
+        hold = holds.get(book_id)
+    if hold is not None and user_id is not None and hold["user_id"] == user_id:
+        del holds[book_id]
+        forget_reservation(user_id, book_id)
+        record_loan(book_id, loan_id, hold)
+        reservation_changed(book)
+        # The hold is returned so undo_borrow can restore it
+        return {"status": "success", "message": "Book marked as borrowed", "hold": hold}
+    if book["available"]:
+        book["available"] = False
+        record_loan(book_id, loan_id, None)
+        storage.put("books", book_id, book)
+        catalog_changed(book)
+        return {"status": "success", "message": "Book marked as borrowed", "hold": None}
+    return {"status": "error", "message": "Book not available"}
+
+
+def undo_borrow(book_id, hold=None):
+    """
+    Take back a borrow, restoring the hold it collected if any.
+    Without a hold the copy goes to the next reserver, as if it had been returned.
+    """
+    book = books_by_id.get(book_id)
+    if book is None:
+        return {"status": "error", "message": "Book not found"}
+    forget_loan(book_id)
+    if hold is not None:
+        holds[book_id] = hold
+        reservations_by_user.setdefault(hold["user_id"], set()).add(book_id)
+        reservation_changed(book)
+    elif book_id not in holds:
+        hand_off(book)
+    return {"status": "success", "message": "Borrow undone"}
+
+
+def cancel_borrow(book_id, loan_id):
+    """
+    Undo the borrow made with loan_id, restoring the hold it collected if any.
+    Any other borrow of the book, or none, is left alone, so a late or repeated
+    cancel is harmless.
+    :return: A response telling whether a borrow was cancelled.
+    """
+    loan = loans.get(book_id)
+    if loan is None or loan_id is None or loan["loan_id"] != loan_id:
+        return {"status": "success", "cancelled": False}
+    undo_borrow(book_id, loan["hold"])
+    return {"status": "success", "cancelled": True}
+
+
+def record_loan(book_id, loan_id, hold):
+    """Remember the loan id of a borrow, replacing the book's previous loan."""
+    if loan_id is None:
+        forget_loan(book_id)
+        return
+    loans[book_id] = {"book_id": book_id, "loan_id": loan_id, "hold": hold}
+    storage.put("loans", book_id, loans[book_id])
+
+
+def forget_loan(book_id):
+    if loans.pop(book_id, None) is not None:
+        storage.delete("loans", book_id)
+
+
+def reserve_book(book_id, user_id):
+    """
+    Add a user to the end of a borrowed book's reservation queue.
+    :return: A response with the user's position in the queue.
+    """
+    book = books_by_id.get(book_id)
+    if book is None:
+        return {"status": "error", "message": "Book not found"}
+    if user_id is None:
+        return {"status": "error", "message": "A user_id is required to reserve a book"}
+    if book["available"]:
+        return {"status": "error", "message": "Book is available, no need to reserve"}
+    if book_id in reservations_by_user.get(user_id, ()):
+        return {"status": "error", "message": "You have already reserved this book"}
+    queue = reservation_queues.setdefault(book_id, deque())
+    queue.append(user_id)
+    reservations_by_user.setdefault(user_id, set()).add(book_id)
+    reservation_changed(book)
+    return {"status": "success", "message": "Book reserved successfully", "position": len(queue)}
+
+
+def cancel_reservation(book_id, user_id):
+    """Remove a user from a book's queue, or release the hold they have on it."""
+    book = books_by_id.get(book_id)
+    if book is None or book_id not in reservations_by_user.get(user_id, ()):
+        return {"status": "error", "message": "No reservation found"}
+    forget_reservation(user_id, book_id)
+    hold = holds.get(book_id)
+    if hold is not None and hold["user_id"] == user_id:
+        hand_off(book)
+    else:
+        reservation_queues[book_id].remove(user_id)
+        reservation_changed(book)
+    return {"status": "success", "message": "Reservation cancelled"}
+
+
+def get_reservations(user_id):
+    """
+    List a user's reservations.
+    :return: A response with one entry per book: its position in the queue
+             (0 while a copy is held for the user) and the hold's expiry time.
+    """
+    reservations = []
+    for book_id in sorted(reservations_by_user.get(user_id, ())):
+        hold = holds.get(book_id)
+        if hold is not None and hold["user_id"] == user_id:
+            position, expires = 0, hold["expires"]
+        else:
+            position, expires = reservation_queues[book_id].index(user_id) + 1, None
+        reservations.append({"book_id": book_id, "title": books_by_id[book_id]["title"],
+                             "position": position, "hold_expires": expires})
+    return {"status": "success", "reservations": reservations}
+
+
+def expire_hold(book):
+    """Pass a lapsed hold on to the next user in the queue."""
+    log.info("Hold expired", extra=fields(book_id=book["id"], user_id=holds[book["id"]]["user_id"]))
+    forget_reservation(holds[book["id"]]["user_id"], book["id"])
+    hand_off(book)
+
+
+def hold_sweeper():
+    """Background thread passing on holds that were not collected in time."""
+    while True:
+        time.sleep(HOLD_SWEEP_INTERVAL)
+        with state_lock:
+            now = time.time()
+            for book_id, hold in list(holds.items()):
+                if hold["expires"] <= now:
+                    expire_hold(books_by_id[book_id])
+
+
+def bulk_load_books(chunk):
+    """
+    Stage one chunk of a bulk catalog import.
+    Books are checked for duplicate ids on arrival but only become visible, and
+    only get indexed, when the final chunk arrives, so the indexes are built once.
+    A chunk with an invalid book is rejected whole, so nothing from it is merged later.
+    :param chunk: A dictionary with "books" (a list of books) and "final" (True on the last chunk).
+    :return: A response with the number of books staged, duplicates skipped and books merged.
+    """
+    if not isinstance(chunk, dict):
+        return {"status": "error", "message": "Chunk rejected: payload must be a dictionary"}
+    new_books = chunk.get("books", [])
+    error = invalid_bulk_books(new_books)
+    if error:
+        return {"status": "error", "message": f"Chunk rejected: {error}"}
+
+    staged = duplicates = 0
+    for book in new_books:
+        book.setdefault("available", True)
+        book.setdefault("reserved", False)
+        if book["id"] in books_by_id or book["id"] in staged_books:
+            duplicates += 1
+            continue
+        staged_books[book["id"]] = book
+        staged += 1
+
+    merged = 0
+    if chunk.get("final"):
+        merged = merge_staged_books()
+    return {"status": "success", "staged": staged, "duplicates": duplicates, "merged": merged}
+
+
+def invalid_bulk_books(new_books):
+    """:return: Why a chunk of books cannot be staged, or None if every book can."""
+    if not isinstance(new_books, list):
+        return "books must be a list"
+    for i, book in enumerate(new_books):
+        if not isinstance(book, dict):
+            return f"book {i} is not a dictionary"
+        # Ids are kept sorted, so they must all be integers
+        if not isinstance(book.get("id"), int) or isinstance(book["id"], bool):
+            return f"book {i} has no integer id"
+        # Every client shows the title and author of each book
+        for field in ("title", "author"):
+            if not isinstance(book.get(field), str):
+                return f"book {i} has no {field}"
+    return None
+
+
+def merge_staged_books():
+    """Append every staged book to the catalog, persist it and extend the indexes in one pass."""
+    global book_ids
+    new_books = list(staged_books.values())
+    staged_books.clear()
+    books.extend(new_books)
+    for book in new_books:
+        books_by_id[book["id"]] = book
+        storage.put("books", book["id"], book)
+    book_ids = sorted(books_by_id)
+    search_index.add_many(new_books)
+    catalog_changed()
+    log.info("Bulk loaded books merged", extra=fields(count=len(new_books), books=len(books)))
+    return len(new_books)
+
+
+def get_books_page(options):
+    """
+    Return one page of the catalog in id order.
+    :param options: A dictionary with optional keys:
+        after_id: Keyset cursor, return books with ids greater than this.
+        offset: Number of books to skip when no cursor is given.
+        limit: Maximum number of books to return (all if missing).
+        fields: List of book fields to include, e.g. ["id", "title", "author", "available"].
+    :return: A response containing the page, the catalog total and the cursor for the next page.
+    """
+    if options.get("after_id") is not None:
+        start = bisect.bisect_right(book_ids, options["after_id"])
+    else:
+        start = options.get("offset", 0)
+    limit = options.get("limit")
+    end = len(book_ids) if limit is None else start + limit
+    page = [books_by_id[book_id] for book_id in book_ids[start:end]]
+
+    fields = options.get("fields")
+    if fields:
+        page = [{field: book[field] for field in fields if field in book} for book in page]
+
+    next_after_id = book_ids[end - 1] if page and end < len(book_ids) else None
+    return {"books": page, "total": len(book_ids), "next_after_id": next_after_id}
+
+
+def search_books(options):
+    """
+    Search the catalog by title or author.
+    :param options: A dictionary with keys:
+        query: The search text; an empty string matches every book.
+        limit: Maximum number of books to return (all if missing).
+        prefix: True to match word prefixes (typeahead) instead of substrings.
+    :return: A response containing the matching books, or an error for a malformed search.
+    """
+    query = options.get("query", "")
+    limit = options.get("limit")
+    if not isinstance(query, str):
+        return {"status": "error", "message": "query must be a string"}
+    # bool is an int subclass, but {"limit": true} is a malformed request, not a limit of 1
+    if limit is not None and (not isinstance(limit, int) or isinstance(limit, bool) or limit < 0):
+        return {"status": "error", "message": "limit must be a non-negative integer"}
+    return {"books": search_index.search(query, limit, bool(options.get("prefix", False)))}
+
 
-        socket.send(json.dumps(response).encode())
 if __name__ == "__main__":
     book_service()
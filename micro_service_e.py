@@ -0,0 +1,224 @@
+# Microservice E: Borrow and Return Coordinator
+import itertools
+import threading
+import time
+import uuid
+from service_logging import configure_logging, fields, get_logger
+from storage import MemoryStorage, open_storage
+from zmq_client import ServiceError, communicate_with_microservice
+from zmq_server import default_workers, serve
+
+log = get_logger("micro_service_e")
+
+# Seconds to wait for Microservice B or D to answer one step. A transaction runs
+# at most three steps inline, so it answers within about 3 * STEP_TIMEOUT *
+# (STEP_RETRIES + 1) seconds; clients must wait longer (service_caller.PORT_TIMEOUTS)
+STEP_TIMEOUT = 2
+# Retries for each step; steps carry request ids, so services never run one twice
+STEP_RETRIES = 1
+# Seconds between attempts to run compensations that could not be delivered
+COMPENSATION_RETRY_INTERVAL = 10
+# Transactions wait on other services, so run several at once unless told otherwise
+DEFAULT_WORKERS = 4
+
+pending_compensations = {}  # id -> step still to be delivered, see queue_compensation
+compensation_ids = itertools.count()
+storage = MemoryStorage()  # Replaced by the configured backend in load_state()
+compensation_lock = threading.Lock()
+
+
+def coordinator_service(workers=None):
+    """
+    Microservice E: Borrows and returns books across Microservices B and D as one request.
+    Operations:
+        - borrow_book: Mark the book borrowed in D and record the loan in B, or neither.
+        - return_book: End the loan in B, then make the book available (or hand it
+          to the next reserver) in D.
+    Clients make retries safe by sending each request with a request id (see
+    zmq_server.Dispatcher), so a resent transaction gets the first run's reply.
+    """
+    configure_logging("micro_service_e")
+    load_state()
+    threading.Thread(target=compensation_loop, daemon=True).start()
+    if workers is None:
+        workers = default_workers() or DEFAULT_WORKERS
+    log.info("Microservice E (Borrow/Return Coordinator) is running...",
+             extra=fields(pending_compensations=len(pending_compensations)))
+    try:
+        serve(5559, handle_request, workers, operations=OPERATIONS)  # Bind to port 5559 for the coordinator
+    finally:
+        storage.close()
+
+
+def load_state():
+    """Open the configured storage backend and reload undelivered compensations."""
+    global storage, compensation_ids
+    storage = open_storage("micro_service_e")
+    state = storage.load()
+    for compensation in state.get("compensations", []):
+        pending_compensations[compensation["id"]] = compensation["step"]
+    compensation_ids = itertools.count(max(pending_compensations, default=-1) + 1)
+
+
+# Operations handle_request answers, named in the request metrics
+OPERATIONS = ("borrow_book", "return_book")
+
+
+def handle_request(data):
+    """
+    Dispatch a single request to its transaction.
+    :param data: The decoded [operation, payload] request.
+    :return: The response to send back.
+    """
+    operation = data[0]  # Operation type
+    payload = data[1]    # Data sent with the request
+
+    if operation == "borrow_book":
+        # Payload is {"user_id": ..., "book_id": ..., "title": ...}
+        response = borrow_book(payload)
+
+    elif operation == "return_book":
+        # Payload is {"user_id": ..., "book_id": ...}
+        response = return_book(payload)
+
+    else:
+        response = {"status": "error", "message": "Invalid operation"}
+
+    return response
+
+
+def call_step(port, operation, payload, request_id):
+    """
+    Send one step of a transaction, retrying on timeouts.
+    :param request_id: Id of this step; the service answers a resent step with its original reply.
+    :return: The service's reply, or None if it did not answer (the outcome is unknown).
+    """
+    try:
+        return communicate_with_microservice(port, operation, payload, STEP_TIMEOUT, STEP_RETRIES,
+                                             request_id=request_id)
+    except ServiceError:
+        return None
+
+
+def succeeded(reply):
+    return reply is not None and reply.get("status") == "success"
+
+
+def unavailable(service):
+    return {"status": "error", "message": f"{service} is unavailable, please try again"}
+
+
+def compensate(port, operation, payload, request_id):
+    """Undo a step that went through, queueing the compensation for retry if the service cannot be reached."""
+    if call_step(port, operation, payload, request_id) is None:
+        queue_compensation(port, operation, payload, request_id)
+
+
+def queue_compensation(port, operation, payload, request_id, then=None):
+    """
+    Persist a step for compensation_loop to deliver once the service is back.
+    :param then: Optional step [port, operation, payload, request id] to deliver
+                 next, once this one has succeeded.
+    """
+    log.warning("Compensation queued for retry", extra=fields(port=port, operation=operation, request_id=request_id))
+    with compensation_lock:
+        compensation_id = next(compensation_ids)
+        step = [port, operation, payload, request_id, then]
+        pending_compensations[compensation_id] = step
+        storage.put("compensations", compensation_id, {"id": compensation_id, "step": step})
+
+
+def compensation_loop():
+    """Background thread delivering compensations that failed earlier."""
+    while True:
+        time.sleep(COMPENSATION_RETRY_INTERVAL)
+        with compensation_lock:
+            pending = list(pending_compensations.items())
+        for compensation_id, step in pending:
+            port, operation, payload, request_id = step[:4]
+            then = step[4] if len(step) > 4 else None  # Steps queued before follow-ups existed have none
+            reply = call_step(port, operation, payload, request_id)
+            if reply is None:
+                continue
+            with compensation_lock:
+                if then is not None and succeeded(reply):
+                    # The follow-up takes this step's place, so it is delivered even after a restart
+                    step = then + [None]
+                    pending_compensations[compensation_id] = step
+                    storage.put("compensations", compensation_id, {"id": compensation_id, "step": step})
+                else:
+                    del pending_compensations[compensation_id]
+                    storage.delete("compensations", compensation_id)
+
+
+def borrow_book(request):
+    """
+    Borrow a book as a saga: D marks the book borrowed first, since it knows
+    whether a copy is free, then B records the loan. If B refuses, D is undone;
+    B is never asked to end a loan, so a refused borrow leaves no trace in the
+    borrowing history. Both services get the run id as the loan id, so a step
+    whose reply was lost can be cancelled without touching any other loan.
+    :param request: A dictionary containing user_id, book_id and title.
+    :return: A response indicating success (with the due date) or failure.
+    """
+    user_id, book_id = request["user_id"], request["book_id"]
+    run_id = uuid.uuid4().hex  # Names this run's steps, so each service runs them at most once
+    d_reply = call_step(5557, "borrow_book", {"book_id": book_id, "user_id": user_id, "loan_id": run_id},
+                        f"{run_id}:d:borrow_book")
+    if d_reply is None:
+        # D may have marked the book borrowed before its reply was lost. D was just
+        # unreachable, so the cancel is queued rather than tried again now
+        queue_compensation(5557, "cancel_borrow", {"book_id": book_id, "loan_id": run_id}, f"{run_id}:d:cancel_borrow")
+        return unavailable("Microservice D")
+    if not succeeded(d_reply):
+        return {"status": "error", "message": d_reply.get("message", "Failed to borrow book.")}
+
+    b_reply = call_step(5556, "borrow_book",
+                        {"user_id": user_id, "book_id": book_id, "title": request.get("title"), "loan_id": run_id},
+                        f"{run_id}:b:borrow_book")
+    if succeeded(b_reply):
+        return {"status": "success", "message": "Book borrowed successfully", "due_date": b_reply["due_date"]}
+
+    compensate(5557, "undo_borrow", {"book_id": book_id, "hold": d_reply.get("hold")}, f"{run_id}:d:undo_borrow")
+    if b_reply is None:
+        # B may have recorded the loan before its reply was lost. B was just
+        # unreachable, so the cancel is queued rather than tried again now
+        queue_compensation(5556, "cancel_borrow", {"user_id": user_id, "book_id": book_id, "loan_id": run_id},
+                           f"{run_id}:b:cancel_borrow")
+        return unavailable("Microservice B")
+    return {"status": "error", "message": b_reply.get("message", "Failed to borrow book.")}
+
+
+def return_book(request):
+    """
+    Return a book: B ends the loan first, since it knows whether the user has the
+    book, then D is told. If D stays unreachable its return is delivered later
+    instead of undoing the return in B. If B's reply is lost, B's return is
+    resent later under the same request id, so B runs it at most once, and D is
+    told once B has confirmed it.
+    :param request: A dictionary containing user_id and book_id.
+    :return: A response indicating success, failure, or a return still pending.
+    """
+    user_id, book_id = request["user_id"], request["book_id"]
+    run_id = uuid.uuid4().hex
+    b_return = [5556, "return_book", {"user_id": user_id, "book_id": book_id}, f"{run_id}:b:return_book"]
+    d_return = [5557, "return_book", book_id, f"{run_id}:d:return_book"]
+    b_reply = call_step(*b_return)
+    if b_reply is None:
+        # B may have ended the loan already; a fresh run from the client would not
+        # know, so this run is finished in the background instead
+        queue_compensation(*b_return, then=d_return)
+        return {"status": "pending", "held_for": None,
+                "message": "Microservice B is unavailable; the return will be completed once it is back"}
+    if not succeeded(b_reply):
+        return {"status": "error", "message": b_reply.get("message", "Failed to return book.")}
+
+    d_reply = call_step(*d_return)
+    if d_reply is None:
+        queue_compensation(*d_return)
+        return {"status": "success", "message": "Book returned successfully", "held_for": None}
+    return {"status": "success", "message": "Book returned successfully", "held_for": d_reply.get("held_for")}
+
+
+if __name__ == "__main__":
+    coordinator_service()
@@ -0,0 +1,89 @@
+# Client-side cache of microservice read requests
+import json
+import threading
+import time
+from zmq_client import send_request
+
+# Seconds a cached response is reused without asking the service at all
+DEFAULT_TTL = 10
+
+
+class CacheEntry:
+    def __init__(self, version, response, expires):
+        self.version = version
+        self.response = response
+        self.expires = expires
+
+
+class RequestCache:
+    """
+    Caches replies to read requests, keyed by port and request.
+    A fresh entry (younger than its TTL) is returned with no round trip. An
+    expired entry is revalidated with an "if_changed" conditional request, so
+    the service only sends the full reply again if its data version changed.
+    Callers invalidate entries after their own mutations.
+    """
+
+    def __init__(self, ttl=DEFAULT_TTL):
+        self.ttl = ttl
+        self._entries = {}  # (port, encoded request) -> CacheEntry
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(port, operation, data):
+        return port, json.dumps([operation, data], sort_keys=True)
+
+    def fetch_versioned(self, port, operation, data=None, timeout=None, ttl=None):
+        """
+        Return a possibly cached reply and the data version it reflects.
+        :param ttl: Seconds to reuse the reply without revalidating, or None for the cache default.
+        :return: (version or None, reply).
+        """
+        ttl = self.ttl if ttl is None else ttl
+        key = self._key(port, operation, data)
+        with self._lock:
+            entry = self._entries.get(key)
+        now = time.monotonic()
+        if entry is not None and now < entry.expires:
+            return entry.version, entry.response
+
+        since = entry.version if entry is not None else None
+        reply = send_request(port, ["if_changed", [since, [operation, data]]], timeout=timeout)
+        if reply.get("status") == "not_modified":
+            entry.expires = now + ttl
+            return entry.version, entry.response
+        if reply.get("status") != "modified":
+            # Error from the envelope itself; nothing to cache
+            return None, reply
+
+        response = reply["response"]
+        version = reply["version"]
+        with self._lock:
+            if version is None:
+                # The service cannot version this request, so it must not be reused
+                self._entries.pop(key, None)
+            else:
+                self._entries[key] = CacheEntry(version, response, now + ttl)
+        return version, response
+
+    def fetch(self, port, operation, data=None, timeout=None, ttl=None):
+        """Return a possibly cached reply to [operation, data] from the service on port."""
+        return self.fetch_versioned(port, operation, data, timeout, ttl)[1]
+
+    def invalidate(self, port, operation=None, data=None):
+        """
+        Drop cached replies for a port, optionally only for one operation
+        (and, when data is given, only for that exact request).
+        """
+        with self._lock:
+            if operation is not None and data is not None:
+                self._entries.pop(self._key(port, operation, data), None)
+                return
+            prefix = json.dumps([operation])[:-1] if operation is not None else None
+            for key in list(self._entries):
+                if key[0] == port and (prefix is None or key[1].startswith(prefix)):
+                    del self._entries[key]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
@@ -0,0 +1,285 @@
+# Full-text search index over book titles and authors
+import bisect
+import heapq
+import itertools
+import re
+
+SEARCH_FIELDS = ("title", "author")
+TITLE, AUTHOR = range(len(SEARCH_FIELDS))
+# Grams of every length up to this are indexed, so short queries hit the index too
+MAX_GRAM = 3
+# A tier holding fewer than 1/SPARSE_SHARE of the books is sorted by title directly;
+# a larger one is read off the title-sorted list, which finds a page within a few entries
+SPARSE_SHARE = 8
+
+_token_pattern = re.compile(r"\w+")
+
+
+def normalize(text):
+    return str(text).lower()
+
+
+def tokenize(text):
+    return _token_pattern.findall(normalize(text))
+
+
+def grams(text):
+    """Return every substring of text up to MAX_GRAM characters long."""
+    return {text[i:i + n] for n in range(1, MAX_GRAM + 1) for i in range(len(text) - n + 1)}
+
+
+def _add_posting(index, key, book_id, vocabulary=None, sort_vocabulary=True):
+    postings = index.get(key)
+    if postings is not None:
+        postings.add(book_id)
+        return
+    index[key] = {book_id}
+    if vocabulary is not None:
+        if sort_vocabulary:
+            bisect.insort(vocabulary, key)
+        else:
+            vocabulary.append(key)
+
+
+def _remove_posting(index, key, book_id, vocabulary=None):
+    postings = index[key]
+    postings.discard(book_id)
+    if not postings:
+        del index[key]
+        if vocabulary is not None:
+            del vocabulary[bisect.bisect_left(vocabulary, key)]
+
+
+class SearchIndex:
+    """
+    Token and n-gram index over the title and author of each book.
+    Substring queries intersect the posting sets of the query's grams and then
+    confirm the match on the cached lowercased fields, so results are the same
+    as a full scan. Prefix queries look up the sorted token vocabulary instead.
+    Results are ranked in tiers (see search), and each tier is read from the
+    index in title order, so a search with a limit stops as soon as it is full.
+    """
+
+    def __init__(self, books=()):
+        self._books = {}  # book id -> book
+        self._fields = {}  # book id -> lowercased (title, author)
+        self._grams = ({}, {})  # per field: gram -> set of book ids
+        self._tokens = {}  # token -> set of book ids
+        self._vocabulary = []  # sorted list of indexed tokens
+        self._title_tokens = {}  # title token -> set of book ids
+        self._title_vocabulary = []  # sorted list of title tokens
+        self._sequence = itertools.count()  # Orders books with equal titles
+        self._order = {}  # book id -> (lowercased title, sequence number)
+        self._by_title = []  # sorted list of (lowercased title, sequence number, book id)
+        self._by_author = []  # sorted list of (lowercased author, sequence number, book id)
+        for book in books:
+            self.add(book)
+
+    def __len__(self):
+        return len(self._books)
+
+    def add(self, book):
+        """Index a book, replacing any previous entry with the same id."""
+        self._add(book)
+
+    def add_many(self, books):
+        """Index many books at once, sorting the vocabulary only at the end."""
+        batch = {book["id"]: book for book in books}
+        # Replaced entries are removed first, while the vocabulary is still sorted
+        for book_id in batch:
+            self.remove(book_id)
+        for book in batch.values():
+            self._add(book, sort_vocabulary=False)
+        self._vocabulary.sort()
+        self._title_vocabulary.sort()
+        self._by_title.sort()
+        self._by_author.sort()
+
+    def _add(self, book, sort_vocabulary=True):
+        book_id = book["id"]
+        if book_id in self._books:
+            self.remove(book_id)
+        fields = tuple(normalize(book.get(field, "")) for field in SEARCH_FIELDS)
+        self._books[book_id] = book
+        self._fields[book_id] = fields
+        for field, gram_index in zip(fields, self._grams):
+            for gram in grams(field):
+                _add_posting(gram_index, gram, book_id)
+        title_tokens = set(tokenize(fields[TITLE]))
+        for token in title_tokens.union(tokenize(fields[AUTHOR])):
+            _add_posting(self._tokens, token, book_id, self._vocabulary, sort_vocabulary)
+        for token in title_tokens:
+            _add_posting(self._title_tokens, token, book_id, self._title_vocabulary, sort_vocabulary)
+        sequence = next(self._sequence)
+        self._order[book_id] = (fields[TITLE], sequence)
+        for entries, field in ((self._by_title, fields[TITLE]), (self._by_author, fields[AUTHOR])):
+            if sort_vocabulary:
+                bisect.insort(entries, (field, sequence, book_id))
+            else:
+                entries.append((field, sequence, book_id))
+
+    def remove(self, book_id):
+        """Drop a book from the index if it is present."""
+        if book_id not in self._books:
+            return
+        del self._books[book_id]
+        fields = self._fields.pop(book_id)
+        for field, gram_index in zip(fields, self._grams):
+            for gram in grams(field):
+                _remove_posting(gram_index, gram, book_id)
+        title_tokens = set(tokenize(fields[TITLE]))
+        for token in title_tokens.union(tokenize(fields[AUTHOR])):
+            _remove_posting(self._tokens, token, book_id, self._vocabulary)
+        for token in title_tokens:
+            _remove_posting(self._title_tokens, token, book_id, self._title_vocabulary)
+        _, sequence = self._order.pop(book_id)
+        for entries, field in ((self._by_title, fields[TITLE]), (self._by_author, fields[AUTHOR])):
+            del entries[bisect.bisect_left(entries, (field, sequence))]
+
+    def clear(self):
+        self._books.clear()
+        self._fields.clear()
+        for gram_index in self._grams:
+            gram_index.clear()
+        self._tokens.clear()
+        self._vocabulary.clear()
+        self._title_tokens.clear()
+        self._title_vocabulary.clear()
+        self._order.clear()
+        self._by_title.clear()
+        self._by_author.clear()
+
+    def _substring_ids(self, query, field, verify=True):
+        """
+        Ids of the books whose field contains query; the set may be the index's own and must not be changed.
+        :param verify: False to skip confirming long queries on the field, returning a superset.
+        """
+        gram_index = self._grams[field]
+        if len(query) <= MAX_GRAM:
+            return gram_index.get(query, frozenset())
+        # Overlapping grams of the longest length, rarest first
+        query_grams = sorted({query[i:i + MAX_GRAM] for i in range(len(query) - MAX_GRAM + 1)},
+                             key=lambda gram: len(gram_index.get(gram, ())))
+        candidates = set(gram_index.get(query_grams[0], ()))
+        for gram in query_grams[1:]:
+            if not candidates:
+                break
+            candidates &= gram_index.get(gram, set())
+        if not verify:
+            return candidates
+        fields = self._fields
+        return {book_id for book_id in candidates if query in fields[book_id][field]}
+
+    @staticmethod
+    def _prefix_postings(prefix, index, vocabulary):
+        """Union of the postings of every vocabulary token starting with prefix."""
+        ids = set()
+        for i in range(bisect.bisect_left(vocabulary, prefix), len(vocabulary)):
+            if not vocabulary[i].startswith(prefix):
+                break
+            ids |= index[vocabulary[i]]
+        return ids
+
+    @staticmethod
+    def _sorted_prefix(entries, prefix):
+        """Book ids of the (field, sequence, id) entries whose field starts with prefix, in field order."""
+        for i in range(bisect.bisect_left(entries, (prefix,)), len(entries)):
+            field, _, book_id = entries[i]
+            if not field.startswith(prefix):
+                break
+            yield book_id
+
+    def _prefix_candidates(self, query):
+        query_tokens = tokenize(query)
+        if not query_tokens:
+            return set(self._books)
+        candidates = None
+        for token in query_tokens:
+            ids = self._prefix_postings(token, self._tokens, self._vocabulary)
+            candidates = ids if candidates is None else candidates & ids
+            if not candidates:
+                break
+        return candidates
+
+    def _in_title_order(self, ids, limit, accept=None):
+        """
+        The first limit (or all) of ids, ordered by title.
+        :param accept: Optional test each id must also pass, applied only as far as needed.
+        """
+        if len(ids) * SPARSE_SHARE < len(self._books):
+            if accept is not None:
+                ids = [book_id for book_id in ids if accept(book_id)]
+            key = self._order.__getitem__
+            return sorted(ids, key=key) if limit is None else heapq.nsmallest(limit, ids, key=key)
+        if limit is None:
+            return [book_id for _, _, book_id in self._by_title
+                    if book_id in ids and (accept is None or accept(book_id))]
+        ordered = []
+        for _, _, book_id in self._by_title:
+            if book_id in ids and (accept is None or accept(book_id)):
+                ordered.append(book_id)
+                if len(ordered) == limit:
+                    break
+        return ordered
+
+    def search(self, query, limit=None, prefix=False):
+        """
+        Find books whose title or author matches the query, best matches first:
+        exact title, title prefix, title word prefix, title substring, author
+        prefix, then any other match, each tier in title order.
+        :param query: The search text (case-insensitive).
+        :param limit: Maximum number of results, or None for all.
+        :param prefix: Match each query word against word prefixes (typeahead) instead of substrings.
+        :return: A list of books.
+        :raises ValueError: If limit is negative.
+        """
+        if limit is not None and limit < 0:
+            raise ValueError("limit must not be negative")
+        if limit == 0:
+            return []
+        query = normalize(query)
+        if not query:
+            return list(itertools.islice(self._books.values(), limit))
+        # Every substring match contains the query in its title or author, so the
+        # tiers below are exactly the matches; prefix matches are filtered on them
+        matches = self._prefix_candidates(query) if prefix else None
+        if matches is not None and not matches:
+            return []
+
+        ids = []
+        # Exact titles and title prefixes, already in title order
+        for book_id in self._sorted_prefix(self._by_title, query):
+            if matches is None or book_id in matches:
+                ids.append(book_id)
+                if len(ids) == limit:
+                    return [self._books[book_id] for book_id in ids]
+        seen = set(ids)
+
+        tiers = (
+            lambda: self._prefix_postings(query, self._title_tokens, self._title_vocabulary),
+            lambda: self._substring_ids(query, TITLE),
+            lambda: set(self._sorted_prefix(self._by_author, query)),
+        )
+        for tier in tiers:
+            tier_ids = tier()
+            if matches is not None:
+                tier_ids = tier_ids & matches
+            if seen:
+                tier_ids = tier_ids - seen
+            ids += self._in_title_order(tier_ids, None if limit is None else limit - len(ids))
+            if len(ids) == limit:
+                return [self._books[book_id] for book_id in ids]
+            seen |= tier_ids
+
+        # Then every other match. For substring queries those are the author matches,
+        # whose gram candidates are only confirmed as far as the page needs
+        if matches is None:
+            fields = self._fields
+            rest = self._substring_ids(query, AUTHOR, verify=False)
+            accept = lambda book_id: query in fields[book_id][AUTHOR]
+        else:
+            rest, accept = matches, None
+        if seen:
+            rest = rest - seen
+        ids += self._in_title_order(rest, None if limit is None else limit - len(ids), accept)
+        return [self._books[book_id] for book_id in ids]
@@ -0,0 +1,165 @@
+# Runs microservice calls off the Tk main loop
+import queue
+from concurrent.futures import ThreadPoolExecutor
+from events import EventSubscriber
+from request_cache import RequestCache
+from zmq_client import communicate_with_microservice, send_batch
+
+# Seconds to wait for a microservice before reporting it as unavailable
+DEFAULT_TIMEOUT = 5
+# Microservice E waits on B and D in turn, so it gets longer than its worst case
+# of three steps (see micro_service_e.STEP_TIMEOUT and STEP_RETRIES)
+PORT_TIMEOUTS = {5559: 15}
+# Resends of a timed-out request that carries a request id
+RETRIES = 2
+# How often the Tk main loop checks for finished calls, in milliseconds
+POLL_MS = 20
+
+
+class Call:
+    """Handle for a background call; cancel() stops its callback from running."""
+
+    def __init__(self, on_result, on_error):
+        self.on_result = on_result
+        self.on_error = on_error
+        self.future = None
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+        if self.future is not None:
+            self.future.cancel()
+
+
+class ServiceCaller:
+    """
+    Thread pool for blocking microservice calls.
+    Results are queued by the worker threads and handed to the callbacks on the
+    Tk main loop by a root.after() poll, so callbacks may update widgets freely.
+    Calls submitted for a screen are cancelled by cancel_screen() when the user
+    navigates away, so their callbacks never touch destroyed widgets.
+    """
+
+    def __init__(self, root, workers=4, timeout=DEFAULT_TIMEOUT, on_error=None, cache=None):
+        self.root = root
+        self.timeout = timeout
+        self.cache = cache or RequestCache()
+        self.on_error = on_error  # Used for calls submitted without their own error callback
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="service-call")
+        self._results = queue.Queue()
+        self._screen_calls = []
+        self._subscribers = []
+        self._poll_id = self.root.after(POLL_MS, self._poll)
+
+    def call(self, function, args, on_result, on_error=None, screen=True):
+        """
+        Run function(*args) on a worker thread.
+        :param on_result: Called on the main loop with the return value.
+        :param on_error: Called on the main loop with the exception, if any.
+        :param screen: Whether the call belongs to the current screen and is cancelled with it.
+        :return: A Call handle.
+        """
+        call = Call(on_result, on_error)
+        call.future = self._executor.submit(self._run, call, function, args)
+        if screen:
+            self._screen_calls.append(call)
+        return call
+
+    def _run(self, call, function, args):
+        try:
+            self._results.put((call, function(*args), None))
+        except Exception as e:
+            self._results.put((call, None, e))
+
+    def request(self, port, operation, data, on_result, on_error=None, screen=True, request_id=None):
+        """
+        Send one [operation, data] request to a microservice in the background.
+        :param request_id: Optional unique id for a request that changes data; the
+                           service runs it at most once, so it is retried after a timeout.
+        """
+        timeout = PORT_TIMEOUTS.get(port, self.timeout)
+        if request_id is None:
+            args = (port, operation, data, timeout)
+        else:
+            args = (port, operation, data, timeout, RETRIES, None, request_id)
+        return self.call(communicate_with_microservice, args, on_result, on_error, screen)
+
+    def cached_request(self, port, operation, data, on_result, on_error=None, screen=True):
+        """Like request(), but served from the read cache when the reply is still valid."""
+        return self.call(self.cache.fetch, (port, operation, data, self.timeout), on_result, on_error, screen)
+
+    def batch(self, port, requests, on_result, on_error=None, screen=True):
+        """Send a batch of requests to one microservice in the background."""
+        return self.call(send_batch, (port, requests, self.timeout), on_result, on_error, screen)
+
+    def gather(self, calls, on_result, on_error=None, screen=True):
+        """
+        Run several (function, args) calls concurrently.
+        on_result receives the list of results once all have finished; on_error
+        receives the first exception instead if any call fails.
+        """
+        results = [None] * len(calls)
+        remaining = [len(calls)]
+        failed = []
+        on_error = on_error or self.on_error
+
+        def finish(index, value, error):
+            if failed:
+                return
+            if error is not None:
+                failed.append(error)
+                if on_error is not None:
+                    on_error(error)
+                return
+            results[index] = value
+            remaining[0] -= 1
+            if remaining[0] == 0:
+                on_result(results)
+
+        return [self.call(function, args,
+                          lambda value, i=i: finish(i, value, None),
+                          lambda error, i=i: finish(i, None, error),
+                          screen)
+                for i, (function, args) in enumerate(calls)]
+
+    def subscribe(self, port, topics, on_event):
+        """
+        Receive a service's change events on the Tk main loop.
+        :param port: The service's event port (see events.EVENT_PORTS).
+        :param topics: Topic prefixes to receive.
+        :param on_event: Called on the main loop with (topic, event).
+        """
+        call = Call(lambda args: on_event(*args), None)
+        self._subscribers.append(EventSubscriber(port, topics, lambda topic, event: self._results.put((call, (topic, event), None))))
+
+    def cancel_screen(self):
+        """Cancel every call that belongs to the screen being left."""
+        for call in self._screen_calls:
+            call.cancel()
+        self._screen_calls = []
+
+    def _poll(self):
+        # Reschedule first so a failing callback cannot stop delivery
+        self._poll_id = self.root.after(POLL_MS, self._poll)
+        while True:
+            try:
+                call, result, error = self._results.get_nowait()
+            except queue.Empty:
+                break
+            if call in self._screen_calls:
+                self._screen_calls.remove(call)
+            if call.cancelled:
+                continue
+            if error is None:
+                call.on_result(result)
+            elif call.on_error is not None:
+                call.on_error(error)
+            elif self.on_error is not None:
+                self.on_error(error)
+
+    def shutdown(self):
+        """Stop polling and abandon calls that have not started yet."""
+        self.root.after_cancel(self._poll_id)
+        for subscriber in self._subscribers:
+            subscriber.stop()
+        self._executor.shutdown(wait=False, cancel_futures=True)
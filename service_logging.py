@@ -0,0 +1,123 @@
+# Leveled, structured logging for the microservices
+import atexit
+import copy
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import sys
+import time
+
+# Environment variables configuring every service's logging
+LEVEL_ENV = "LOG_LEVEL"  # DEBUG, INFO (default), WARNING, ERROR
+FORMAT_ENV = "LOG_FORMAT"  # json (default) or text
+SAMPLE_ENV = "LOG_SAMPLE_RATE"  # Fraction of DEBUG records kept, default 1
+
+ROOT_LOGGER = "library"
+
+_listener = None
+
+
+def get_logger(name):
+    """Return the logger for one module; records go nowhere until configure_logging() runs."""
+    return logging.getLogger(f"{ROOT_LOGGER}.{name}")
+
+
+def fields(**values):
+    """Structured fields for a record: log.info("Borrowed", extra=fields(user_id=1))."""
+    return {"fields": values}
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line: time, level, service, logger, message and any structured fields."""
+
+    def __init__(self, service):
+        super().__init__()
+        self.service = service
+
+    def format(self, record):
+        entry = {
+            "ts": time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(record.created)) + f".{int(record.msecs):03d}",
+            "level": record.levelname,
+            "service": self.service,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        entry.update(getattr(record, "fields", {}))
+        if record.exc_info:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry["exception"] = record.exc_text
+        return json.dumps(entry, default=str)
+
+
+class TextFormatter(logging.Formatter):
+    """Human-readable lines for development, with structured fields appended as key=value."""
+
+    def __init__(self, service):
+        super().__init__(f"%(asctime)s %(levelname)s {service} %(name)s: %(message)s")
+
+    def formatMessage(self, record):
+        line = super().formatMessage(record)  # The traceback, if any, follows the fields
+        extra = getattr(record, "fields", None)
+        if extra:
+            line += " " + " ".join(f"{key}={value}" for key, value in extra.items())
+        return line
+
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    """Queue records with their arguments and traceback rendered, but not merged into the message."""
+
+    def prepare(self, record):
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+        record.exc_info = None  # Tracebacks cannot cross the queue
+        return record
+
+
+class SamplingFilter(logging.Filter):
+    """Keep every record at INFO and above, but only a random fraction of DEBUG records."""
+
+    def __init__(self, rate):
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record):
+        return record.levelno > logging.DEBUG or self.rate >= 1 or random.random() < self.rate
+
+
+def configure_logging(service, level=None, log_format=None, sample_rate=None):
+    """
+    Send the service's log records through a queue to a background thread that
+    formats and writes them, so request handling never blocks on stdout.
+    Arguments default to the LOG_LEVEL, LOG_FORMAT and LOG_SAMPLE_RATE environment variables.
+    :param service: The service name included in every record.
+    """
+    global _listener
+    level = level or os.environ.get(LEVEL_ENV, "INFO")
+    log_format = log_format or os.environ.get(FORMAT_ENV, "json")
+    if sample_rate is None:
+        sample_rate = float(os.environ.get(SAMPLE_ENV, "1"))
+
+    output = logging.StreamHandler(sys.stdout)
+    output.setFormatter(JsonFormatter(service) if log_format == "json" else TextFormatter(service))
+
+    records = queue.SimpleQueue()
+    handler = _QueueHandler(records)
+    handler.addFilter(SamplingFilter(sample_rate))
+
+    logger = logging.getLogger(ROOT_LOGGER)
+    logger.handlers[:] = [handler]
+    logger.setLevel(level.upper())
+    logger.propagate = False
+
+    if _listener is not None:
+        _listener.stop()
+    _listener = logging.handlers.QueueListener(records, output)
+    _listener.start()
+    atexit.register(_listener.stop)
@@ -0,0 +1,255 @@
+# Pluggable persistence for microservice state
+import json
+import os
+import sqlite3
+import threading
+
+# Environment variables selecting the backend for every service
+BACKEND_ENV = "STORAGE_BACKEND"  # memory (default), sqlite or wal
+DIR_ENV = "STORAGE_DIR"
+SYNC_ENV = "STORAGE_SYNC"  # batch (default) or always
+
+# Group commit: flush at most this often, or sooner once this many writes are pending
+FLUSH_INTERVAL = 0.05
+FLUSH_BATCH = 1000
+# WAL backend: write a fresh snapshot after this many logged operations
+SNAPSHOT_EVERY = 100000
+
+
+def encode_key(key):
+    return json.dumps(key)
+
+
+class MemoryStorage:
+    """No-op backend: state lives only in the service's own structures."""
+
+    def load(self):
+        """
+        Read back every stored collection.
+        :return: A dictionary of collection name -> list of records, in insertion order.
+        """
+        return {}
+
+    def put(self, collection, key, record):
+        """Insert or replace a record."""
+
+    def delete(self, collection, key):
+        """Delete a record if it exists."""
+
+    def clear(self, collection):
+        """Delete every record in a collection."""
+
+    def flush(self):
+        """Make every write so far durable."""
+
+    def close(self):
+        self.flush()
+
+
+class _GroupCommitStorage(MemoryStorage):
+    """
+    Base for durable backends. Writes are buffered and made durable together,
+    either on every write (sync="always") or by a background thread every
+    FLUSH_INTERVAL seconds and whenever FLUSH_BATCH writes are pending (sync="batch").
+    """
+
+    def __init__(self, sync="batch", flush_interval=FLUSH_INTERVAL, flush_batch=FLUSH_BATCH):
+        self.sync = sync
+        self.flush_interval = flush_interval
+        self.flush_batch = flush_batch
+        self._lock = threading.RLock()
+        self._pending = 0
+        self._closed = threading.Event()
+        self._flusher = None
+        if sync == "batch":
+            self._flusher = threading.Thread(target=self._flush_loop, daemon=True)
+            self._flusher.start()
+
+    def _flush_loop(self):
+        while not self._closed.wait(self.flush_interval):
+            self.flush()
+
+    def _write(self, op, collection, key, record):
+        raise NotImplementedError
+
+    def _commit(self):
+        raise NotImplementedError
+
+    def _apply(self, op, collection, key=None, record=None):
+        with self._lock:
+            self._write(op, collection, key, record)
+            self._pending += 1
+            if self.sync == "always" or self._pending >= self.flush_batch:
+                self.flush()
+
+    def put(self, collection, key, record):
+        self._apply("put", collection, key, record)
+
+    def delete(self, collection, key):
+        self._apply("delete", collection, key)
+
+    def clear(self, collection):
+        self._apply("clear", collection)
+
+    def flush(self):
+        with self._lock:
+            if self._pending:
+                self._commit()
+                self._pending = 0
+
+    def close(self):
+        self._closed.set()
+        if self._flusher is not None:
+            self._flusher.join()
+        self.flush()
+
+
+class SQLiteStorage(_GroupCommitStorage):
+    """Stores each record as a JSON row in a single SQLite table."""
+
+    def __init__(self, path, **kwargs):
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=FULL")
+        self._db.execute("CREATE TABLE IF NOT EXISTS records ("
+                         "collection TEXT NOT NULL, key TEXT NOT NULL, value TEXT NOT NULL, "
+                         "PRIMARY KEY (collection, key))")
+        self._in_transaction = False
+        super().__init__(**kwargs)
+
+    def load(self):
+        state = {}
+        rows = self._db.execute("SELECT collection, value FROM records ORDER BY rowid")
+        for collection, value in rows:
+            state.setdefault(collection, []).append(json.loads(value))
+        return state
+
+    def _write(self, op, collection, key, record):
+        if not self._in_transaction:
+            self._db.execute("BEGIN")
+            self._in_transaction = True
+        if op == "put":
+            # Upsert keeps the rowid, so records load back in insertion order
+            self._db.execute("INSERT INTO records (collection, key, value) VALUES (?, ?, ?) "
+                             "ON CONFLICT (collection, key) DO UPDATE SET value = excluded.value",
+                             (collection, encode_key(key), json.dumps(record)))
+        elif op == "delete":
+            self._db.execute("DELETE FROM records WHERE collection = ? AND key = ?",
+                             (collection, encode_key(key)))
+        elif op == "clear":
+            self._db.execute("DELETE FROM records WHERE collection = ?", (collection,))
+
+    def _commit(self):
+        self._db.execute("COMMIT")
+        self._in_transaction = False
+
+    def close(self):
+        super().close()
+        self._db.close()
+
+
+class WalStorage(_GroupCommitStorage):
+    """
+    Append-only write-ahead log of JSON lines plus periodic JSON snapshots.
+    On load the latest snapshot is read and the log replayed on top of it.
+    """
+
+    def __init__(self, directory, snapshot_every=SNAPSHOT_EVERY, **kwargs):
+        os.makedirs(directory, exist_ok=True)
+        self.snapshot_path = os.path.join(directory, "snapshot.json")
+        self.log_path = os.path.join(directory, "wal.log")
+        self.snapshot_every = snapshot_every
+        self._state = self._read()
+        self._logged = 0
+        self._log = open(self.log_path, "a", encoding="utf-8")
+        super().__init__(**kwargs)
+
+    def _read(self):
+        state = {}  # collection -> {encoded key: record}
+        if os.path.exists(self.snapshot_path):
+            with open(self.snapshot_path, encoding="utf-8") as f:
+                state = json.load(f)
+        if os.path.exists(self.log_path):
+            good_end = 0  # Byte offset just past the last complete record
+            with open(self.log_path, "rb") as f:
+                for line in f:
+                    if not line.endswith(b"\n"):
+                        break  # Torn final write from a crash
+                    try:
+                        op, collection, key, record = json.loads(line)
+                    except ValueError:
+                        break
+                    self._replay(state, op, collection, key, record)
+                    good_end += len(line)
+            if good_end < os.path.getsize(self.log_path):
+                # Cut off the torn tail, or new records would be appended onto it and lost on the next replay
+                os.truncate(self.log_path, good_end)
+        return state
+
+    @staticmethod
+    def _replay(state, op, collection, key, record):
+        if op == "put":
+            state.setdefault(collection, {})[key] = record
+        elif op == "delete":
+            state.get(collection, {}).pop(key, None)
+        elif op == "clear":
+            state.pop(collection, None)
+
+    def load(self):
+        with self._lock:
+            return {collection: list(records.values()) for collection, records in self._state.items()}
+
+    def _write(self, op, collection, key, record):
+        key = None if key is None else encode_key(key)
+        line = json.dumps([op, collection, key, record])
+        # Replay a copy decoded from the log line: the caller keeps changing its own
+        # record, and snapshot() serializes _state from the flusher thread
+        self._replay(self._state, op, collection, key, json.loads(line)[3])
+        self._log.write(line + "\n")
+        self._logged += 1
+
+    def _commit(self):
+        self._log.flush()
+        os.fsync(self._log.fileno())
+        if self._logged >= self.snapshot_every:
+            self.snapshot()
+
+    def snapshot(self):
+        """Write the full state to a new snapshot and start an empty log."""
+        with self._lock:
+            tmp_path = self.snapshot_path + ".tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(self._state, f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self.snapshot_path)
+            self._log.close()
+            self._log = open(self.log_path, "w", encoding="utf-8")
+            self._logged = 0
+
+    def close(self):
+        super().close()
+        self._log.close()
+
+
+def open_storage(name, backend=None, directory=None, sync=None):
+    """
+    Open the storage backend for a service, configured by environment variables
+    unless given explicitly.
+    :param name: The service name, used for the database file or log directory.
+    :param backend: "memory", "sqlite" or "wal".
+    :param directory: Directory holding the service's data files.
+    :param sync: "batch" for group commit or "always" to sync every write.
+    :return: A storage object.
+    """
+    backend = backend or os.environ.get(BACKEND_ENV, "memory")
+    directory = directory or os.environ.get(DIR_ENV, "data")
+    sync = sync or os.environ.get(SYNC_ENV, "batch")
+    if backend == "memory":
+        return MemoryStorage()
+    if backend == "sqlite":
+        os.makedirs(directory, exist_ok=True)
+        return SQLiteStorage(os.path.join(directory, f"{name}.sqlite3"), sync=sync)
+    if backend == "wal":
+        return WalStorage(os.path.join(directory, name), sync=sync)
+    raise ValueError(f"Unknown storage backend: {backend}")
@@ -0,0 +1,36 @@
+# Write throughput benchmark for the storage backends
+# Usage: python storage_benchmark.py [writes]
+import sys
+import tempfile
+import time
+from storage import SQLiteStorage, WalStorage
+
+
+def run(storage, writes):
+    """
+    Write borrow-style records and return the sustained writes per second,
+    including the final flush.
+    """
+    start = time.perf_counter()
+    for i in range(writes):
+        record = {"user_id": f"user{i % 1000}", "book_id": i, "title": f"Book {i}",
+                  "borrowed_date": "2024-11-02", "due_date": "2024-11-09", "status": "borrowed"}
+        storage.put("borrowed_books", [record["user_id"], i], record)
+    storage.flush()
+    elapsed = time.perf_counter() - start
+    storage.close()
+    return writes / elapsed
+
+
+if __name__ == "__main__":
+    writes = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    # Syncing every write is orders of magnitude slower, so use fewer writes for it
+    always_writes = max(writes // 20, 1)
+
+    print(f"{'backend':<8} {'sync':<7} {'writes':>8} {'writes/s':>12}")
+    with tempfile.TemporaryDirectory() as directory:
+        for sync, count in (("batch", writes), ("always", always_writes)):
+            sqlite = SQLiteStorage(f"{directory}/bench-{sync}.sqlite3", sync=sync)
+            print(f"{'sqlite':<8} {sync:<7} {count:>8} {run(sqlite, count):>12.0f}")
+            wal = WalStorage(f"{directory}/bench-{sync}-wal", sync=sync)
+            print(f"{'wal':<8} {sync:<7} {count:>8} {run(wal, count):>12.0f}")
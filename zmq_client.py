@@ -0,0 +1,241 @@
+# Shared ZeroMQ client layer used by the desktop app and the microservices
+import threading
+import time
+import zmq
+import codec
+from idempotency import IN_PROGRESS
+
+# Seconds an idle socket may sit in the pool before it is recycled
+MAX_IDLE_SECONDS = 60
+# Maximum number of idle sockets kept per port
+MAX_POOL_SIZE = 8
+# Seconds to wait before the first retry of a failed request; doubled for each further retry
+RETRY_BACKOFF = 0.1
+
+
+class ServiceError(Exception):
+    """Raised when a microservice cannot be reached or does not reply."""
+
+
+class CircuitOpenError(ServiceError):
+    """Raised without contacting a microservice while its circuit breaker is open."""
+
+
+class CircuitBreaker:
+    """
+    Fails requests to an unhealthy microservice fast instead of letting each one time out.
+    After failure_threshold consecutive failures the breaker opens and requests fail
+    at once. After reset_timeout seconds a single trial request is let through
+    (half-open); its outcome closes the breaker again or re-opens it.
+    """
+
+    def __init__(self, failure_threshold=5, reset_timeout=10):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0  # Consecutive failures
+        self.opened_at = None  # When the breaker last opened, or None while closed
+        self._trial = False  # Whether the half-open trial request is in flight
+        self._lock = threading.Lock()
+
+    @property
+    def is_open(self):
+        return self.opened_at is not None
+
+    def allow(self):
+        """Return whether a request may be sent now."""
+        with self._lock:
+            if self.opened_at is None:
+                return True
+            if self._trial or time.monotonic() - self.opened_at < self.reset_timeout:
+                return False
+            self._trial = True
+            return True
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self._trial = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self._trial or self.failures >= self.failure_threshold:
+                self.opened_at = time.monotonic()
+            self._trial = False
+
+
+class ConnectionPool:
+    """
+    Pool of reusable REQ sockets connected to a single microservice.
+    A socket is only returned to the pool after a complete send/recv round trip,
+    so every pooled socket is in a clean REQ state and ready to send.
+    """
+
+    def __init__(self, port, host="localhost", max_size=MAX_POOL_SIZE, max_idle=MAX_IDLE_SECONDS):
+        self.address = f"tcp://{host}:{port}"
+        self.max_size = max_size
+        self.max_idle = max_idle
+        self.codec = codec.default_codec()  # Switched to JSON if the service cannot decode it
+        self._idle = []  # (socket, last_used) pairs, most recently used last
+        self._lock = threading.Lock()
+
+    def _new_socket(self):
+        socket = zmq.Context.instance().socket(zmq.REQ)
+        socket.setsockopt(zmq.LINGER, 0)
+        socket.setsockopt(zmq.RECONNECT_IVL, 100)
+        socket.setsockopt(zmq.RECONNECT_IVL_MAX, 5000)
+        # Let libzmq detect dead peers on idle connections
+        socket.setsockopt(zmq.HEARTBEAT_IVL, 10000)
+        socket.setsockopt(zmq.HEARTBEAT_TIMEOUT, 30000)
+        socket.connect(self.address)
+        return socket
+
+    def acquire(self):
+        """
+        Take a healthy socket from the pool or open a new one.
+        :return: A connected REQ socket owned by the caller until released.
+        """
+        now = time.monotonic()
+        with self._lock:
+            while self._idle:
+                socket, last_used = self._idle.pop()
+                if socket.closed:
+                    continue
+                if now - last_used > self.max_idle:
+                    socket.close()
+                    continue
+                return socket
+        return self._new_socket()
+
+    def release(self, socket):
+        """Return a socket that completed its round trip to the pool."""
+        with self._lock:
+            if not socket.closed and len(self._idle) < self.max_size:
+                self._idle.append((socket, time.monotonic()))
+                return
+        socket.close()
+
+    def discard(self, socket):
+        """Close a socket whose REQ state is unknown (error or timeout)."""
+        socket.close()
+
+    def close(self):
+        """Close every idle socket in the pool."""
+        with self._lock:
+            for socket, _ in self._idle:
+                socket.close()
+            self._idle.clear()
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(port, host="localhost"):
+    """Return the process-wide connection pool for a microservice port."""
+    key = (host, port)
+    with _pools_lock:
+        pool = _pools.get(key)
+        if pool is None:
+            pool = ConnectionPool(port, host)
+            _pools[key] = pool
+        return pool
+
+
+def send_request(port, request, timeout=None, host="localhost", retries=0, breaker=None, request_id=None):
+    """
+    Send a raw request to a microservice over a pooled socket.
+    :param port: The port the microservice is bound to.
+    :param request: The request body.
+    :param timeout: Seconds to wait for each attempt's reply, or None to wait forever.
+    :param retries: How many times to resend after a timeout. Only safe for requests
+                    that may run twice, since the first attempt may have been handled,
+                    or for requests sent with a request_id.
+    :param breaker: Optional CircuitBreaker tracking the health of the microservice; a call
+                    counts as one failure once every attempt has timed out.
+    :param request_id: Optional unique id; the service runs a request at most once per
+                       id and answers duplicates with the original reply. A resend the
+                       service is still running is polled again after timeout seconds,
+                       as long as retries remain.
+    :return: The decoded reply (an IN_PROGRESS reply if the retries ran out first).
+    :raises ServiceError: If no attempt got a reply (CircuitOpenError if the breaker is open).
+    """
+    pool = get_pool(port, host)
+    if request_id is not None:
+        request = ["idempotent", [request_id, request]]
+    for attempt in range(retries + 1):
+        if breaker is not None and not breaker.allow():
+            raise CircuitOpenError(f"Circuit open for port {port}; not sending request")
+        try:
+            reply = _send(pool, port, request, timeout)
+        except ServiceError:
+            if attempt == retries:
+                # One failure per call, so the breaker's threshold counts calls, not attempts
+                if breaker is not None:
+                    breaker.record_failure()
+                raise
+            # Idle sockets share the failed connection, so retry on a new one
+            pool.close()
+            time.sleep(RETRY_BACKOFF * 2 ** attempt)
+            continue
+        if breaker is not None:
+            breaker.record_success()
+        if (request_id is not None and attempt < retries and isinstance(reply, dict)
+                and reply.get("status") == IN_PROGRESS):
+            # The first attempt is still running; give it as long as an attempt gets
+            time.sleep(timeout if timeout is not None else RETRY_BACKOFF * 2 ** attempt)
+            continue
+        return reply
+
+
+def _send(pool, port, request, timeout):
+    reply = _round_trip(pool, port, request, timeout, pool.codec)
+    if isinstance(reply, dict) and reply.get("unsupported_codec") == pool.codec:
+        # The service cannot decode our preferred codec, so use JSON from now on
+        pool.codec = codec.JSON
+        reply = _round_trip(pool, port, request, timeout, pool.codec)
+    return reply
+
+
+def _round_trip(pool, port, request, timeout, codec_name):
+    socket = pool.acquire()
+    try:
+        socket.send_multipart(codec.encode_frames(request, codec_name))
+        if timeout is not None and not socket.poll(int(timeout * 1000), zmq.POLLIN):
+            raise ServiceError(f"Timed out waiting for reply from port {port}")
+        frames = socket.recv_multipart()
+    except BaseException:
+        # The REQ state machine is stuck mid round trip, so reconnect next time
+        pool.discard(socket)
+        raise
+    pool.release(socket)
+    return codec.decode_frames(frames)[0]
+
+
+def communicate_with_microservice(port, operation, data=None, timeout=None, retries=0, breaker=None, request_id=None):
+    """Helper function to communicate with other microservices (see send_request)."""
+    return send_request(port, [operation, data], timeout=timeout, retries=retries, breaker=breaker,
+                        request_id=request_id)
+
+
+def send_batch(port, requests, timeout=None):
+    """
+    Send many requests to one microservice in a single round trip.
+    :param port: The port the microservice is bound to.
+    :param requests: A list of [operation, payload] requests.
+    :param timeout: Seconds to wait for the reply, or None to wait forever.
+    :return: The list of replies, in request order.
+    """
+    reply = send_request(port, ["batch", requests], timeout=timeout)
+    if reply.get("status") != "success":
+        raise ServiceError(reply.get("message", f"Batch request to port {port} failed"))
+    return reply["results"]
+
+
+def close_all():
+    """Close every pooled socket, e.g. before the process exits."""
+    with _pools_lock:
+        for pool in _pools.values():
+            pool.close()
+        _pools.clear()
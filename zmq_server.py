@@ -0,0 +1,242 @@
+# Shared request loop for the microservices
+import os
+import threading
+import time
+import zmq
+from contextlib import nullcontext
+import codec
+from idempotency import IdempotencyCache
+from service_logging import fields, get_logger
+from metrics import HTTP_PORT_OFFSET, ServiceMetrics, http_enabled, serve_http
+
+log = get_logger("zmq_server")
+
+
+def default_workers():
+    """
+    Number of worker threads to run, read from the SERVICE_WORKERS environment variable.
+    0 (the default) keeps the classic single-threaded REP loop.
+    """
+    return int(os.environ.get("SERVICE_WORKERS", "0"))
+
+# Operation name of the envelope that carries many requests in one message
+BATCH_OPERATION = "batch"
+# Operation name of the envelope that only runs a request if its result may have changed
+CONDITIONAL_OPERATION = "if_changed"
+# Operation name of the envelope that runs a request at most once per request id
+IDEMPOTENT_OPERATION = "idempotent"
+# Operation every service answers with its request metrics
+STATS_OPERATION = "stats"
+# Metrics label of requests whose operation the service does not recognise
+OTHER_OPERATION = "other"
+
+# Distinguishes versions handed out by this process from those of an earlier run
+BOOT_ID = f"{int(time.time() * 1000):x}"
+
+
+def make_version(*parts):
+    """Build a version tag that is never reused across service restarts."""
+    return ":".join([BOOT_ID, *map(str, parts)])
+
+
+def operation_name(data):
+    """Name a request for the metrics, looking inside envelopes that wrap a single request."""
+    if not isinstance(data, list) or not data:
+        return "invalid"
+    operation = data[0]
+    if operation in (CONDITIONAL_OPERATION, IDEMPOTENT_OPERATION) and len(data) == 2:
+        try:
+            return operation_name(data[1][1])
+        except (TypeError, IndexError, KeyError):
+            return "invalid"
+    if isinstance(operation, dict):
+        # Microservice A names operations like {'sign_in': True}, and stores a lone dict as a message
+        if len(data) == 1 and not (len(operation) == 1 and next(iter(operation.values())) is True):
+            return "store_message"
+        return next(iter(operation), "invalid")
+    return str(operation)
+
+
+def run_request(data, handle_request):
+    """Run one request, turning an unexpected exception into an error reply."""
+    try:
+        return handle_request(data)
+    except Exception as e:
+        log.exception("Request failed", extra=fields(operation=operation_name(data)))
+        return {"status": "error", "message": f"Internal error: {e}"}
+
+
+class Dispatcher:
+    """
+    Turns request frames into reply frames for one service, handling the
+    envelopes every service understands around the service's own handler.
+    """
+
+    def __init__(self, handle_request, lock=None, version=None, idempotency=None, metrics=None, operations=None):
+        """
+        :param handle_request: Function taking the decoded request and returning the reply.
+        :param lock: Optional lock held while a request is handled and its reply encoded.
+        :param version: Optional function returning the version of the data a request
+            reads, or None if the request cannot be served conditionally.
+        :param idempotency: Cache of replies by request id, or None for a default IdempotencyCache.
+        :param metrics: ServiceMetrics to record requests in, or None for a new one.
+        :param operations: Names of the service's operations. Metrics of any other
+            operation are recorded as "other", so clients cannot add labels at will.
+        """
+        self.handle_request = handle_request
+        self.lock = lock
+        self.version = version
+        self.idempotency = idempotency or IdempotencyCache()
+        self.metrics = metrics or ServiceMetrics()
+        self.operations = None
+        if operations is not None:
+            self.operations = {*operations, BATCH_OPERATION, STATS_OPERATION, "invalid"}
+
+    def run_batch(self, requests):
+        """
+        Run every request of a batch envelope in order.
+        :param requests: A list of [operation, payload] requests.
+        :return: A response with one result per request; a failing request only affects its own result.
+        """
+        if not isinstance(requests, list):
+            return {"status": "error", "message": "Batch payload must be a list of requests"}
+        return {"status": "success", "results": [self.run(request) for request in requests]}
+
+    def run_conditional(self, payload):
+        """
+        Run a request only if the data it reads changed since the client's version.
+        :param payload: [version the client holds (or None), request].
+        :return: {"status": "not_modified", "version": v} or
+                 {"status": "modified", "version": v, "response": reply}; v is None
+                 when the request cannot be versioned and the client must not reuse it.
+        """
+        if not (isinstance(payload, list) and len(payload) == 2):
+            return {"status": "error", "message": "Conditional payload must be [version, request]"}
+        since, request = payload
+        current = None
+        if self.version is not None:
+            try:
+                current = self.version(request)
+            except Exception:
+                current = None
+        if current is not None and current == since:
+            return {"status": "not_modified", "version": current}
+        return {"status": "modified", "version": current, "response": self.run(request)}
+
+    def run_idempotent(self, payload):
+        """
+        Run a request unless a request with the same id already ran.
+        :param payload: [request id chosen by the client, request].
+        :return: The reply, the original reply for a duplicate.
+        """
+        if not (isinstance(payload, list) and len(payload) == 2):
+            return {"status": "error", "message": "Idempotent payload must be [request id, request]"}
+        request_id, request = payload
+        if not isinstance(request_id, (str, int)) or isinstance(request_id, bool):
+            return {"status": "error", "message": "Request id must be a string or an integer"}
+        return self.idempotency.run(request_id, request, self.run)
+
+    def run(self, data):
+        """Run one decoded request, unwrapping any envelope."""
+        if isinstance(data, list) and len(data) == 2:
+            if data[0] == BATCH_OPERATION:
+                return self.run_batch(data[1])
+            if data[0] == CONDITIONAL_OPERATION:
+                return self.run_conditional(data[1])
+            if data[0] == IDEMPOTENT_OPERATION:
+                return self.run_idempotent(data[1])
+            if data[0] == STATS_OPERATION:
+                return self.metrics.stats()
+        return run_request(data, self.handle_request)
+
+    def handle_message(self, frames):
+        """
+        Decode one request, run it and encode the reply.
+        The reply uses the same codec as the request (see codec.encode_frames).
+        :param frames: The request frames.
+        :return: The reply frames.
+        """
+        received = time.perf_counter()
+        self.metrics.request_started()
+        try:
+            data, codec_name = codec.decode_frames(frames)
+        except KeyError as e:
+            # Tell the client to fall back to JSON
+            self.metrics.request_running()
+            self.metrics.request_finished("invalid", True, (0, 0, 0, 0), 0, 0)
+            error = {"status": "error", "message": f"Unsupported codec: {e.args[0]}", "unsupported_codec": e.args[0]}
+            return codec.encode_frames(error, codec.JSON)
+        decoded = time.perf_counter()
+        with self.lock or nullcontext():
+            self.metrics.request_running()
+            running = time.perf_counter()
+            # Envelopes unwrap client data too, so they get the same safety net as handlers
+            response = run_request(data, self.run)
+            handled = time.perf_counter()
+            # Replies may reference live service state, so encode before releasing the lock
+            reply = codec.encode_frames(response, codec_name)
+        encoded = time.perf_counter()
+        error = isinstance(response, dict) and response.get("status") == "error"
+        operation = operation_name(data)
+        if self.operations is not None and operation not in self.operations:
+            operation = OTHER_OPERATION
+        self.metrics.request_finished(operation, error,
+                                      (decoded - received, running - decoded, handled - running, encoded - handled),
+                                      sum(len(frame) for frame in frames), sum(len(frame) for frame in reply))
+        return reply
+
+
+def serve_socket(socket, dispatcher):
+    """Answer requests on a REP socket forever."""
+    while True:
+        frames = socket.recv_multipart()
+        socket.send_multipart(dispatcher.handle_message(frames))
+
+
+def _worker(context, backend_address, dispatcher):
+    socket = context.socket(zmq.REP)
+    socket.connect(backend_address)
+    serve_socket(socket, dispatcher)
+
+
+def serve(port, handle_request, workers=None, lock=None, version=None, operations=None):
+    """
+    Bind a microservice to a port and answer requests forever.
+    With workers > 0 a ROUTER frontend fans requests out over an inproc DEALER
+    backend to that many worker threads, so one slow request does not stall the
+    others. Services whose handlers only touch in-memory state pass a lock that
+    is held per request; services that call other services lock their own state.
+    :param port: The TCP port to bind.
+    :param handle_request: Function taking the decoded request and returning the reply.
+    :param workers: Number of worker threads, or None to use default_workers().
+    :param lock: Optional lock held around each request.
+    :param version: Optional function giving the data version a request reads (see Dispatcher).
+    :param operations: Names of the operations handle_request recognises, for the metrics labels.
+    Request metrics are answered to the stats operation and, with METRICS_HTTP=1,
+    served for Prometheus at http://localhost:<port + 1000>/metrics.
+    """
+    if workers is None:
+        workers = default_workers()
+    context = zmq.Context.instance()
+    metrics = ServiceMetrics(port)
+    if http_enabled():
+        serve_http(metrics, port + HTTP_PORT_OFFSET)
+    dispatcher = Dispatcher(handle_request, lock, version, metrics=metrics, operations=operations)
+
+    if workers <= 0:
+        socket = context.socket(zmq.REP)
+        socket.bind(f"tcp://*:{port}")
+        serve_socket(socket, dispatcher)
+        return
+
+    frontend = context.socket(zmq.ROUTER)
+    frontend.bind(f"tcp://*:{port}")
+    backend_address = f"inproc://workers-{port}"
+    backend = context.socket(zmq.DEALER)
+    backend.bind(backend_address)
+
+    for _ in range(workers):
+        thread = threading.Thread(target=_worker, args=(context, backend_address, dispatcher), daemon=True)
+        thread.start()
+
+    zmq.proxy(frontend, backend)